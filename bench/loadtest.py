@@ -0,0 +1,366 @@
+"""Офлайн навантажувальний тест: main:app проти заглушок Bot API та LLM.
+
+Бот запускається окремим процесом uvicorn, заглушки — у процесі тесту.
+Синтетичні користувачі проходять /start -> усі кроки майстра ->
+confirm_generation -> regenerate, надсилаючи апдейти на WEBHOOK_PATH.
+
+Запуск:
+    python -m bench.loadtest --users 50 --concurrency 20 --llm-latency 2 --output bench_output.json
+
+Результат — JSON (пропускна здатність, p50/p95/p99 по етапах, час до першого
+допису, пам'ять на сесію), придатний для порівняння між запусками.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+import httpx
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stub_llm import StubConfig, create_app as create_llm_app  # noqa: E402
+from bench.stub_telegram import StubTelegram  # noqa: E402
+from wizard import STEPS  # noqa: E402
+
+BOT_TOKEN = "123456:BENCH-TOKEN"
+WEBHOOK_PATH = "/webhook"
+CONFIRM_TEXT = "Перевірте введені дані"
+FINAL_TEXTS = ("Що робимо далі?", "Спробувати згенерувати ще раз?")
+ERROR_FINAL_TEXT = "Спробувати згенерувати ще раз?"
+PROBE_CHAT_ID = 1  # чат для заміру першої відповіді; синтетичні користувачі — з 10000
+# Дописи надсилаються в HTML (заголовок варіанта — <b>), без розмітки — якщо Telegram її не прийняв
+FIRST_POST_PREFIXES = ("<b>Варіант", "## Варіант", "Не вдалося", "❌")
+TEXT_ANSWERS = {
+    'features': "Панорамні вікна, тепла підлога, прихована гардеробна",
+    'street': "Французький бульвар",
+    'district': "Аркадія",
+    'complexName': "Гагарін Плаза",
+    'area': "64",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def serve(app, port: int):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+def rss_kb(pid: int):
+    """Resident set size процесу разом з дочірніми (воркери uvicorn) в КБ (лише Linux)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            total = next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), None)
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return None
+    if total is None:
+        return None
+    return total + sum(rss_kb(child) or 0 for child in children)
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {
+        "count": len(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 4),
+        "mean": round(sum(ordered) / len(ordered), 4),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = StubTelegram()
+        self.rng = random.Random(args.seed)
+        self.update_id = 0
+        self.stages = defaultdict(list)
+        self.time_to_first_post = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = []
+        self.updates_sent = 0
+        self.backpressure = 0
+        self.completed = 0
+
+    # --- Апдейти ---
+    def _next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message_update(self, chat_id: int, text: str) -> dict:
+        update_id = self._next_update_id()
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "from": user, "text": text,
+        }}
+
+    def callback_update(self, chat_id: int, data: str, message_id: int) -> dict:
+        update_id = self._next_update_id()
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": data,
+            "message": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": "",
+            },
+        }}
+
+    async def post(self, update: dict):
+        while True:
+            response = await self.client.post(self.webhook_url, json=update)
+            self.updates_sent += 1
+            if response.status_code != 503:
+                response.raise_for_status()
+                return
+            self.backpressure += 1
+            await asyncio.sleep(1)
+
+    # --- Сценарій користувача ---
+    async def wait_sent(self, chat_id: int, predicate, start: int):
+        return await self.telegram.wait_for(
+            chat_id, lambda e: e["method"] == "sendMessage" and predicate(e["text"]), start, self.args.timeout,
+        )
+
+    async def generation(self, chat_id: int, stage: str, data: str, message_id: int, start: int):
+        started_at = time.perf_counter()
+        await self.post(self.callback_update(chat_id, data, message_id))
+        first, idx = await self.wait_sent(
+            chat_id, lambda text: text.startswith(FIRST_POST_PREFIXES), start,
+        )
+        self.time_to_first_post[stage].append(first["at"] - started_at)
+        final, idx = await self.wait_sent(chat_id, lambda text: text in FINAL_TEXTS, idx)
+        self.stages[stage].append(final["at"] - started_at)
+        if final["text"] == ERROR_FINAL_TEXT:
+            self.errors[stage] += 1
+        return final, idx
+
+    async def run_user(self, chat_id: int):
+        rng = random.Random(self.rng.random())
+        think = self.args.think_time
+
+        started_at = time.perf_counter()
+        await self.post(self.message_update(chat_id, "/start"))
+        question, idx = await self.wait_sent(chat_id, lambda text: text == STEPS[0].question, 0)
+        self.stages["start"].append(question["at"] - started_at)
+
+        for step in STEPS:
+            await asyncio.sleep(think)
+            expected = STEPS[step.index + 1].question if step.index + 1 < len(STEPS) else CONFIRM_TEXT
+            started_at = time.perf_counter()
+            if step.type == 'text':
+                await self.post(self.message_update(chat_id, TEXT_ANSWERS.get(step.key, f"Тест {step.key}")))
+            else:
+                buttons = [button["callback_data"] for row in question["reply_markup"]["inline_keyboard"] for button in row]
+                await self.post(self.callback_update(chat_id, rng.choice(buttons), question["message_id"]))
+            question, idx = await self.wait_sent(chat_id, lambda text, expected=expected: text == expected, idx)
+            self.stages[f"step:{step.key}"].append(question["at"] - started_at)
+
+        await asyncio.sleep(think)
+        final, idx = await self.generation(chat_id, "generate", "confirm_generation", question["message_id"], idx)
+        if not self.args.skip_regenerate:
+            await asyncio.sleep(think)
+            await self.generation(chat_id, "regenerate", "regenerate", final["message_id"], idx)
+        self.completed += 1
+
+    async def run_user_safe(self, chat_id: int, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                await self.run_user(chat_id)
+            except Exception as e:
+                self.errors["session"] += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(f"chat {chat_id}: {type(e).__name__}: {e}")
+
+    # --- Процес бота ---
+    def start_bot(self, workdir: str):
+        env = dict(os.environ)
+        env.update({
+            "TELEGRAM_TOKEN": BOT_TOKEN,
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{self.telegram_port}",
+            "LLM_API_URL": f"http://127.0.0.1:{self.llm_port}/v1/chat/completions",
+            "OPENAI_API_KEY": "bench",
+            "RENDER_EXTERNAL_URL": f"http://127.0.0.1:{self.bot_port}",
+            "FSM_STORAGE_PATH": os.path.join(workdir, "fsm.sqlite3"),
+            "JOB_STORE_PATH": os.path.join(workdir, "jobs.sqlite3"),
+            "POST_HISTORY_PATH": os.path.join(workdir, "history.sqlite3"),
+            "LEADER_LOCK_PATH": os.path.join(workdir, "leader.lock"),
+            "WEB_CONCURRENCY": str(self.args.workers),
+            "ADMIN_ID": "",
+        })
+        if self.args.workers > 1:
+            env["SHARED_STATE_URL"] = "sqlite:" + os.path.join(workdir, "shared.sqlite3")
+        for item in self.args.bot_env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        self.bot_log = open(os.path.join(workdir, "bot.log"), "w")
+        return subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.bot_port),
+             "--workers", str(self.args.workers)],
+            cwd=ROOT, env=env, stdout=self.bot_log, stderr=subprocess.STDOUT,
+        )
+
+    async def wait_ready(self, process) -> float:
+        started_at = time.perf_counter()
+        while time.perf_counter() - started_at < 60:
+            if process.poll() is not None:
+                raise RuntimeError(f"Бот завершився з кодом {process.returncode}")
+            try:
+                response = await self.client.get(f"http://127.0.0.1:{self.bot_port}/")
+                if response.status_code == 200:
+                    return time.perf_counter() - started_at
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.05)
+        raise RuntimeError("Бот не запустився за 60 секунд")
+
+    async def run(self) -> dict:
+        args = self.args
+        self.telegram_port, self.llm_port, self.bot_port = free_port(), free_port(), free_port()
+        self.webhook_url = f"http://127.0.0.1:{self.bot_port}{WEBHOOK_PATH}"
+        llm_app = create_llm_app(StubConfig(
+            latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.llm_error_rate,
+            rpm=args.llm_rpm, chunk_delay=args.llm_chunk_delay,
+            slow_rate=args.llm_slow_rate, slow_latency=args.llm_slow_latency,
+        ))
+        servers = [await serve(self.telegram.app, self.telegram_port), await serve(llm_app, self.llm_port)]
+
+        limits = httpx.Limits(max_connections=args.concurrency + 10)
+        self.client = httpx.AsyncClient(timeout=args.timeout, limits=limits)
+        if args.webhook_registered:
+            self.telegram.webhook_url = self.webhook_url
+        with tempfile.TemporaryDirectory() as workdir:
+            spawned_at = time.perf_counter()
+            process = self.start_bot(workdir)
+            try:
+                ready_after = await self.wait_ready(process)
+                # Холодний старт з погляду користувача: перша відповідь на /start після запуску процесу
+                await self.post(self.message_update(PROBE_CHAT_ID, "/start"))
+                await self.wait_sent(PROBE_CHAT_ID, lambda text: text == STEPS[0].question, 0)
+                first_reply_after = time.perf_counter() - spawned_at
+                rss_before = rss_kb(process.pid)
+
+                semaphore = asyncio.Semaphore(args.concurrency)
+                started_at = time.perf_counter()
+                users = []
+                for idx in range(args.users):
+                    users.append(asyncio.create_task(self.run_user_safe(10_000 + idx, semaphore)))
+                    if args.ramp:
+                        await asyncio.sleep(args.ramp / args.users)
+                await asyncio.gather(*users)
+                wall = time.perf_counter() - started_at
+
+                rss_after = rss_kb(process.pid)
+                bot_stats = (await self.client.get(f"http://127.0.0.1:{self.bot_port}/")).json()
+            finally:
+                process.terminate()
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                self.bot_log.close()
+                await self.client.aclose()
+                for server, task in servers:
+                    server.should_exit = True
+                    await task
+
+        memory = {"rss_before_kb": rss_before, "rss_after_kb": rss_after}
+        if rss_before and rss_after:
+            memory["per_session_kb"] = round((rss_after - rss_before) / max(args.users, 1), 2)
+
+        return {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": git_commit(),
+            "config": vars(args),
+            "startup": {
+                "spawn_to_ready_seconds": round(ready_after, 4),
+                "spawn_to_first_reply_seconds": round(first_reply_after, 4),
+                "bot": bot_stats.get("startup"),  # імпорт main, on_startup, перший апдейт (заміри самого бота)
+            },
+            "sessions": {"started": args.users, "completed": self.completed, "failed": self.errors.get("session", 0)},
+            "wall_seconds": round(wall, 3),
+            "throughput": {
+                "sessions_per_second": round(self.completed / wall, 4) if wall else None,
+                "updates_per_second": round(self.updates_sent / wall, 2) if wall else None,
+                "webhook_503": self.backpressure,
+            },
+            "stages": {name: percentiles(values) for name, values in self.stages.items()},
+            "time_to_first_post": {name: percentiles(values) for name, values in self.time_to_first_post.items()},
+            "memory": memory,
+            "errors": dict(self.errors),
+            "error_samples": self.error_samples,
+            "llm_stub": llm_app.state.stats,
+            "telegram_calls": dict(self.telegram.calls),
+            "bot_stats": bot_stats,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="кількість синтетичних користувачів")
+    parser.add_argument("--concurrency", type=int, default=10, help="скільки сесій іде одночасно")
+    parser.add_argument("--ramp", type=float, default=0.0, help="секунди, за які стартують усі сесії")
+    parser.add_argument("--think-time", type=float, default=1.0, help="пауза користувача між кроками, с")
+    parser.add_argument("--timeout", type=float, default=180.0, help="очікування відповіді бота, с")
+    parser.add_argument("--skip-regenerate", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--webhook-registered", action="store_true",
+                        help="вебхук уже зареєстровано (рестарт без зміни URL)")
+    parser.add_argument("--workers", type=int, default=1, help="кількість процесів uvicorn (WEB_CONCURRENCY)")
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--llm-jitter", type=float, default=0.5)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-rpm", type=int, default=0)
+    parser.add_argument("--llm-chunk-delay", type=float, default=0.005)
+    parser.add_argument("--llm-slow-rate", type=float, default=0.0, help="частка дуже повільних відповідей LLM")
+    parser.add_argument("--llm-slow-latency", type=float, default=30.0)
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="додаткові змінні середовища для процесу бота")
+    parser.add_argument("--output", help="файл для JSON-звіту (за замовчуванням stdout)")
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
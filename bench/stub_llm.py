@@ -0,0 +1,150 @@
+"""Локальна заглушка OpenAI chat-completions для офлайн-перевірок.
+
+Запуск:
+    python -m bench.stub_llm --port 8081 --rpm 30
+    LLM_API_URL=http://127.0.0.1:8081/v1/chat/completions OPENAI_API_KEY=stub python main.py
+
+Повільний «хвіст» (--slow-rate, --slow-latency) і частку помилок можна змінювати
+на льоту: POST /config {"error_rate": 1.0} — напр. щоб перевірити запобіжник.
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.5  # секунди до першого байта
+    jitter: float = 0.0  # секунди, випадкова добавка 0..jitter до latency
+    error_rate: float = 0.0  # частка запитів, на які віддається 500
+    rpm: int = 0  # 0 — без ліміту; інакше понад ліміт у вікні віддається 429
+    window: float = 60.0  # секунди, вікно для ліміту rpm
+    chunk_delay: float = 0.01  # секунди між SSE-фрагментами
+    slow_rate: float = 0.0  # частка запитів, що відповідають із затримкою slow_latency
+    slow_latency: float = 30.0  # секунди
+
+
+def fake_completion(user_prompt: str) -> str:
+    match = re.search(r'Кількість варіантів для генерації: (\d+)', user_prompt)
+    variations = int(match.group(1)) if match else 1
+    return "\n\n".join(
+        f"## Варіант {n}\n🏠 Тестовий допис {n}.\n\n✨ Абзац про ремонт.\n\n#StroyHub #ГалинаОмельченко"
+        for n in range(1, variations + 1)
+    )
+
+
+def create_app(config: StubConfig) -> FastAPI:
+    app = FastAPI()
+    app.state.config = config
+    app.state.stats = {"requests": 0, "rate_limited": 0, "errors": 0, "slow": 0, "models": {}}
+    window = deque()  # час запитів за останню хвилину
+
+    def rate_limit_headers(now: float) -> dict:
+        reset = config.window - (now - window[0]) if window else 0.0
+        return {
+            "x-ratelimit-limit-requests": str(config.rpm),
+            "x-ratelimit-remaining-requests": str(max(config.rpm - len(window), 0)),
+            "x-ratelimit-reset-requests": f"{max(reset, 0):.3f}s",
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.stats
+
+    @app.post("/config")
+    async def update_config(request: Request):
+        for name, value in (await request.json()).items():
+            if hasattr(config, name):
+                setattr(config, name, type(getattr(config, name))(value))
+        return vars(config)
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+        model = body.get("model", "")
+        stats["models"][model] = stats["models"].get(model, 0) + 1
+
+        headers = {}
+        if config.rpm > 0:
+            now = time.monotonic()
+            while window and now - window[0] > config.window:
+                window.popleft()
+            if len(window) >= config.rpm:
+                stats["rate_limited"] += 1
+                headers = rate_limit_headers(now)
+                headers["retry-after"] = str(max(1, round(config.window - (now - window[0]))))
+                return JSONResponse(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                    status_code=429, headers=headers,
+                )
+            window.append(now)
+            headers = rate_limit_headers(now)
+
+        if config.error_rate and random.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "Injected failure", "type": "server_error"}}, status_code=500)
+
+        latency = config.latency + random.uniform(0, config.jitter)
+        if config.slow_rate and random.random() < config.slow_rate:
+            stats["slow"] += 1
+            latency = config.slow_latency
+        await asyncio.sleep(latency)
+        user_prompt = body["messages"][-1]["content"]
+        text = fake_completion(user_prompt)
+        usage = {"prompt_tokens": 1000, "completion_tokens": len(text) // 3, "total_tokens": 1000 + len(text) // 3}
+
+        if not body.get("stream"):
+            return JSONResponse(
+                {"choices": [{"index": 0, "message": {"role": "assistant", "content": text}}], "usage": usage},
+                headers=headers,
+            )
+
+        async def events():
+            for idx in range(0, len(text), 8):
+                chunk = {"choices": [{"index": 0, "delta": {"content": text[idx:idx + 8]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(config.chunk_delay)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=StubConfig.latency)
+    parser.add_argument("--jitter", type=float, default=StubConfig.jitter)
+    parser.add_argument("--error-rate", type=float, default=StubConfig.error_rate)
+    parser.add_argument("--rpm", type=int, default=StubConfig.rpm)
+    parser.add_argument("--window", type=float, default=StubConfig.window)
+    parser.add_argument("--chunk-delay", type=float, default=StubConfig.chunk_delay)
+    parser.add_argument("--slow-rate", type=float, default=StubConfig.slow_rate)
+    parser.add_argument("--slow-latency", type=float, default=StubConfig.slow_latency)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        rpm=args.rpm, window=args.window, chunk_delay=args.chunk_delay,
+        slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Локальна заглушка Telegram Bot API, що записує вихідні запити бота.
+
+Бот підключається до неї через TELEGRAM_API_URL=http://127.0.0.1:<порт>.
+Кожен sendMessage/editMessageText/... зберігається в журналі чату, а
+wait_for дозволяє дочекатися потрібного повідомлення (див. bench.loadtest).
+"""
+import re
+import json
+import time
+import asyncio
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def _parse_form(body: bytes, content_type: str) -> dict:
+    """Розбирає urlencoded або multipart-запит aiogram (файли ігноруються)."""
+    if content_type.startswith("multipart/form-data"):
+        fields = {}
+        for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, flags=re.S):
+            try:
+                fields[name.decode()] = value.decode()
+            except UnicodeDecodeError:
+                fields[name.decode()] = "<binary>"
+        return fields
+    return {key: values[0] for key, values in parse_qs(body.decode(), keep_blank_values=True).items()}
+
+
+def _loads(value):
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class StubTelegram:
+    def __init__(self):
+        self.app = FastAPI()
+        self.log = defaultdict(list)  # chat_id -> [події]
+        self.calls = defaultdict(int)  # метод -> кількість
+        self._conditions = defaultdict(asyncio.Condition)
+        self._message_id = 1000
+        self.webhook_url = ""
+        self.app.post("/bot{token}/{method}")(self._handle)
+
+    def _message(self, chat_id, text=None, message_id=None) -> dict:
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "stub"},
+            "text": text or "",
+        }
+
+    async def _handle(self, token: str, method: str, request: Request):
+        fields = _parse_form(await request.body(), request.headers.get("content-type", ""))
+        self.calls[method] += 1
+        chat_id = _loads(fields.get("chat_id"))
+        result = True
+
+        if method == "getMe":
+            result = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        elif method == "setWebhook":
+            self.webhook_url = fields.get("url", "")
+        elif method == "deleteWebhook":
+            self.webhook_url = ""
+        elif method == "getWebhookInfo":
+            result = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method in ("sendMessage", "sendDocument"):
+            result = self._message(chat_id, fields.get("text") or fields.get("caption"))
+        elif method in ("editMessageText", "editMessageReplyMarkup") and chat_id is not None:
+            result = self._message(chat_id, fields.get("text"), message_id=int(fields.get("message_id", 0)))
+
+        if chat_id is not None:
+            event = {
+                "method": method,
+                "at": time.perf_counter(),
+                "text": fields.get("text") or fields.get("caption") or "",
+                "reply_markup": _loads(fields.get("reply_markup")),
+                "message_id": result["message_id"] if isinstance(result, dict) else _loads(fields.get("message_id")),
+            }
+            condition = self._conditions[chat_id]
+            async with condition:
+                self.log[chat_id].append(event)
+                condition.notify_all()
+        return JSONResponse({"ok": True, "result": result})
+
+    async def wait_for(self, chat_id, predicate, start: int = 0, timeout: float = 120):
+        """Чекає першу подію чату з індексом >= start, що задовольняє predicate.
+
+        Повертає (подія, індекс наступної події).
+        """
+        condition = self._conditions[chat_id]
+
+        async def scan():
+            async with condition:
+                idx = start
+                while True:
+                    events = self.log[chat_id]
+                    while idx < len(events):
+                        if predicate(events[idx]):
+                            return events[idx], idx + 1
+                        idx += 1
+                    await condition.wait()
+
+        return await asyncio.wait_for(scan(), timeout)
@@ -0,0 +1,149 @@
+"""Пакетна генерація: таблиця об'єктів (CSV/XLSX) -> дані форми для кожного рядка -> файл з дописами."""
+import io
+import csv
+import asyncio
+
+from wizard import STEPS
+
+BULK_EXTENSIONS = (".csv", ".xlsx")
+RESULT_COLUMNS = ("row", *(step.key for step in STEPS), "status", "posts", "error")
+
+# Колонку можна назвати ключем кроку (district) або його підписом (Район)
+_COLUMN_ALIASES = {}
+for _step in STEPS:
+    _COLUMN_ALIASES[_step.key.lower()] = _step
+    _COLUMN_ALIASES[_step.label.lower()] = _step
+
+
+class BulkFileError(Exception):
+    """Файл не вдалося прочитати або в ньому немає потрібних колонок."""
+
+
+def _decode(content: bytes) -> str:
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return content.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise BulkFileError("Не вдалося визначити кодування файлу (збережіть його в UTF-8).")
+
+
+def _read_csv(content: bytes) -> list:
+    text = _decode(content)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.reader(io.StringIO(text), dialect))
+
+
+def _read_xlsx(content: bytes) -> list:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise BulkFileError("Для XLSX на сервері потрібен пакет openpyxl — надішліть, будь ласка, CSV.")
+    try:
+        workbook = load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    except Exception as e:
+        raise BulkFileError(f"Не вдалося відкрити XLSX: {e}")
+    sheet = workbook.worksheets[0]
+    return [["" if cell is None else str(cell) for cell in row] for row in sheet.iter_rows(values_only=True)]
+
+
+def read_table(filename: str, content: bytes) -> list:
+    """Рядки таблиці як словники {ключ кроку: значення}; невідомі колонки ігноруються."""
+    name = (filename or "").lower()
+    if name.endswith(".xlsx"):
+        table = _read_xlsx(content)
+    elif name.endswith(".csv"):
+        table = _read_csv(content)
+    else:
+        raise BulkFileError("Підтримуються файли .csv та .xlsx.")
+
+    table = [row for row in table if any(str(cell).strip() for cell in row)]
+    if len(table) < 2:
+        raise BulkFileError("У файлі немає рядків з даними.")
+    columns = [_COLUMN_ALIASES.get(str(cell).strip().lower()) for cell in table[0]]
+    if not any(columns):
+        expected = ", ".join(step.key for step in STEPS)
+        raise BulkFileError(f"Не знайдено жодної відомої колонки. Очікувані назви: {expected}.")
+
+    records = []
+    for row in table[1:]:
+        record = {}
+        for step, value in zip(columns, row):
+            if step is not None:
+                record[step.key] = str(value).strip()
+        records.append(record)
+    return records
+
+
+def validate_record(record: dict):
+    """Перевіряє рядок так само, як майстер: повертає (дані форми, список помилок).
+
+    Порожні текстові поля вважаються пропущеними; для полів із вибором значення
+    обов'язкове і має збігатися з одним із варіантів (без урахування регістру).
+    """
+    form_data, errors = {}, []
+    for step in STEPS:
+        value = record.get(step.key, "")
+        if step.type == 'choice':
+            options = {option.lower(): option for option in step.options}
+            if value.lower() in options:
+                form_data[step.key] = options[value.lower()]
+            elif not value:
+                errors.append(f"{step.key}: порожнє значення")
+            else:
+                errors.append(f"{step.key}: «{value}» — очікується одне з: {', '.join(step.options)}")
+        elif value:
+            form_data[step.key] = value
+    return form_data, errors
+
+
+def validate_records(records: list):
+    """Повертає (список (номер рядка, дані форми), список помилок); номер — як у таблиці (із заголовком)."""
+    rows, errors = [], []
+    for number, record in enumerate(records, start=2):
+        form_data, row_errors = validate_record(record)
+        if row_errors:
+            errors.append(f"Рядок {number}: " + "; ".join(row_errors))
+        else:
+            rows.append((number, form_data))
+    return rows, errors
+
+
+def build_result_csv(rows: list) -> bytes:
+    """CSV з результатами (UTF-8 з BOM, щоб Excel правильно показав кирилицю).
+
+    rows — кортежі (номер рядка, дані форми, статус, текст дописів, помилка).
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(RESULT_COLUMNS)
+    for number, form_data, status, posts, error in rows:
+        writer.writerow([number, *(form_data.get(step.key, "") for step in STEPS), status, posts or "", error or ""])
+    return output.getvalue().encode("utf-8-sig")
+
+
+async def run_pipeline(items: list, worker, concurrency: int, on_progress=None):
+    """Обробляє items не більше ніж concurrency одночасно; помилка одного не зупиняє інших.
+
+    worker(item) — корутина; on_progress(done, failed) викликається після кожного елемента.
+    Повертає кількість невдалих елементів.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    done = failed = 0
+
+    async def process(item):
+        nonlocal done, failed
+        async with semaphore:
+            try:
+                await worker(item)
+            except Exception:
+                failed += 1
+            done += 1
+            if on_progress is not None:
+                await on_progress(done, failed)
+
+    await asyncio.gather(*(process(item) for item in items))
+    return failed
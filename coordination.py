@@ -0,0 +1,285 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+
+from dedupe import InFlightGuard
+
+try:
+    import fcntl
+except ImportError:  # Windows: лише один процес, він і є лідером
+    fcntl = None
+
+
+class LeaderLease:
+    """Вибір лідера серед воркерів однієї машини через файловий замок (flock).
+
+    Замок тримається, поки відкритий файл, і ядро звільняє його, коли процес
+    завершується (навіть аварійно), тож "завислої" оренди не буває.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            self._file = True
+            return True
+        file = open(self.path, "a+")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        file.truncate(0)
+        file.write(str(os.getpid()))
+        file.flush()
+        self._file = file
+        return True
+
+    def release(self):
+        if self._file is not None and self._file is not True:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        self._file = None
+
+
+class MemorySharedState:
+    """Стан лише цього процесу — для режиму з одним воркером (і як заглушка в тестах)."""
+
+    cross_process = False
+
+    def __init__(self):
+        self._marks = {}  # ключ -> час закінчення
+        self._locks = {}  # ключ -> (власник, час закінчення)
+
+    async def add_if_absent(self, key: str, ttl: float) -> bool:
+        """Ставить позначку key на ttl секунд; False, якщо вона вже є."""
+        now = time.time()
+        if self._marks.get(key, 0) > now:
+            return False
+        self._marks[key] = now + ttl
+        return True
+
+    async def discard(self, key: str):
+        self._marks.pop(key, None)
+
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        """Бере (або продовжує власну) оренду замка key на ttl секунд."""
+        now = time.time()
+        current = self._locks.get(key)
+        if current is not None and current[0] != owner and current[1] > now:
+            return False
+        self._locks[key] = (owner, now + ttl)
+        return True
+
+    async def release(self, key: str, owner: str):
+        if self._locks.get(key, (None,))[0] == owner:
+            del self._locks[key]
+
+    async def is_locked(self, key: str) -> bool:
+        return self._locks.get(key, (None, 0))[1] > time.time()
+
+    async def cleanup(self) -> int:
+        now = time.time()
+        expired = [key for key, expires_at in self._marks.items() if expires_at <= now]
+        for key in expired:
+            del self._marks[key]
+        for key in [key for key, (_, expires_at) in self._locks.items() if expires_at <= now]:
+            del self._locks[key]
+        return len(expired)
+
+    def close(self):
+        pass
+
+
+class SQLiteSharedState(MemorySharedState):
+    """Спільний стан воркерів однієї машини у файлі SQLite (WAL).
+
+    Той самий інтерфейс, що й MemorySharedState: інший бекенд (напр. Redis для
+    кількох машин) достатньо реалізувати з цими ж методами і додати в create_shared_state.
+    """
+
+    cross_process = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS marks (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._db_lock, self._conn:
+            return self._conn.execute(sql, params)
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def add_if_absent(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        cursor = await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO marks (key, expires_at) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE marks.expires_at <= ?",
+            (key, now + ttl, now),
+        )
+        return cursor.rowcount > 0
+
+    async def discard(self, key: str):
+        await asyncio.to_thread(self._execute, "DELETE FROM marks WHERE key = ?", (key,))
+
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        cursor = await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO locks (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE locks.owner = excluded.owner OR locks.expires_at <= ?",
+            (key, owner, now + ttl, now),
+        )
+        return cursor.rowcount > 0
+
+    async def release(self, key: str, owner: str):
+        await asyncio.to_thread(self._execute, "DELETE FROM locks WHERE key = ? AND owner = ?", (key, owner))
+
+    async def is_locked(self, key: str) -> bool:
+        rows = await asyncio.to_thread(
+            self._query, "SELECT 1 FROM locks WHERE key = ? AND expires_at > ?", (key, time.time())
+        )
+        return bool(rows)
+
+    async def cleanup(self) -> int:
+        now = time.time()
+
+        def delete():
+            with self._db_lock, self._conn:
+                self._conn.execute("DELETE FROM locks WHERE expires_at <= ?", (now,))
+                return self._conn.execute("DELETE FROM marks WHERE expires_at <= ?", (now,)).rowcount
+
+        return await asyncio.to_thread(delete)
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
+
+
+def create_shared_state(url: str):
+    """Бекенд спільного стану за адресою: "memory" або "sqlite:<шлях до файлу>"."""
+    if not url or url == "memory":
+        return MemorySharedState()
+    if url.startswith("sqlite:"):
+        return SQLiteSharedState(url[len("sqlite:"):])
+    raise ValueError(f"Невідомий бекенд спільного стану: {url}")
+
+
+def _new_owner() -> str:
+    return f"{os.getpid()}-{uuid.uuid4().hex}"
+
+
+@asynccontextmanager
+async def _renewed(state, key: str, owner: str, ttl: float):
+    """Тримає вже взяту оренду key: продовжує її у фоні і звільняє на виході."""
+
+    async def renew():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                await state.acquire(key, owner, ttl)
+            except Exception as e:
+                logging.warning(f"Не вдалося продовжити замок {key}: {e}")
+
+    renewal = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        try:
+            await state.release(key, owner)
+        except Exception as e:
+            logging.warning(f"Не вдалося звільнити замок {key} (звільниться через ttl): {e}")
+
+
+class ChatLocks:
+    """Замки чатів у спільному стані: апдейти одного чату не обробляються двома воркерами одночасно.
+
+    Оренда замка продовжується у фоні, поки апдейт обробляється (генерація
+    може тривати довше за ttl); якщо воркер впав, замок звільняється через ttl.
+    """
+
+    def __init__(self, state, ttl: float = 60, poll_interval: float = 0.02, max_poll_interval: float = 0.2):
+        self.state = state
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.waits = 0  # скільки разів апдейт чекав на інший воркер
+
+    @asynccontextmanager
+    async def hold(self, chat_key):
+        key = f"chat:{chat_key}"
+        owner = _new_owner()  # окремий власник на кожне утримання: замок не реентерабельний
+        delay = self.poll_interval
+        waited = False
+        while not await self.state.acquire(key, owner, self.ttl):
+            waited = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+        if waited:
+            self.waits += 1
+        async with _renewed(self.state, key, owner, self.ttl):
+            yield
+
+
+class SharedInFlightGuard(InFlightGuard):
+    """InFlightGuard, видимий усім воркерам: поки задача виконується, її ключ орендовано в спільному стані.
+
+    Задачу іншого воркера приєднати не можна, тож повторний run того самого ключа
+    в іншому воркері нічого не запускає і повертає None. Без спільного стану
+    (cross_process=False) поводиться так само, як InFlightGuard.
+    """
+
+    def __init__(self, state, ttl: float = 60):
+        super().__init__()
+        self.state = state
+        self.ttl = ttl
+
+    @staticmethod
+    def _lease_key(key) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return "inflight:" + ":".join(str(part) for part in parts)
+
+    async def is_running_anywhere(self, key) -> bool:
+        if self.is_running(key):
+            return True
+        return self.state.cross_process and await self.state.is_locked(self._lease_key(key))
+
+    async def run(self, key, factory):
+        if not self.state.cross_process or self.is_running(key):
+            return await super().run(key, factory)
+        lease_key, owner = self._lease_key(key), _new_owner()
+        if not await self.state.acquire(lease_key, owner, self.ttl):
+            self.joined += 1
+            return None
+
+        async def leased():
+            async with _renewed(self.state, lease_key, owner, self.ttl):
+                return await factory()
+
+        return await super().run(key, leased)
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+
+class UpdateDeduplicator:
+    """Пам'ятає нещодавні update_id у межах часового вікна та ліміту розміру.
+
+    Якщо задано path, стан зберігається у файл при зупинці і читається при
+    старті, щоб повторні доставки після рестарту теж відсікалися.
+    """
+
+    def __init__(self, window: float = 3600, max_size: int = 50000, path: str = None):
+        self.window = window
+        self.max_size = max_size
+        self.path = path
+        self._seen = OrderedDict()  # update_id -> час першої доставки
+        self.duplicates_suppressed = 0
+
+    def _evict(self, now: float):
+        while self._seen:
+            update_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.window and len(self._seen) <= self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+    def check_and_add(self, update_id: int) -> bool:
+        """Повертає True, якщо апдейт уже бачили (і рахує його як дубль)."""
+        now = time.time()
+        self._evict(now)
+        if update_id in self._seen:
+            self.duplicates_suppressed += 1
+            return True
+        self._seen[update_id] = now
+        return False
+
+    def discard(self, update_id: int):
+        """Забуває апдейт, який не вдалося прийняти, щоб повторна доставка пройшла."""
+        self._seen.pop(update_id, None)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                items = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Не вдалося прочитати стан дедуплікації: {e}")
+            return
+        for update_id, seen_at in items:
+            self._seen[int(update_id)] = float(seen_at)
+        self._evict(time.time())
+
+    def save(self):
+        if not self.path:
+            return
+        self._evict(time.time())
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self._seen.items()), f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Не вдалося зберегти стан дедуплікації: {e}")
+
+
+class InFlightGuard:
+    """Не дає запустити дві однакові задачі для одного чату одночасно.
+
+    Повторний виклик run з тим самим ключем приєднується до вже запущеної задачі.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self.joined = 0
+
+    def is_running(self, key) -> bool:
+        task = self._tasks.get(key)
+        return task is not None and not task.done()
+
+    async def run(self, key, factory):
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            self.joined += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.create_task(factory())
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key, None) if self._tasks.get(key) is t else None)
+        return await asyncio.shield(task)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageText, SendChatAction
+
+# Методи, які не витрачають ліміт повідомлень, але мають іти в порядку чату
+UNPACED_METHODS = (DeleteMessage, SendChatAction)
+
+
+class _PendingEdit:
+    __slots__ = ("method", "future")
+
+    def __init__(self, method, future):
+        self.method = method
+        self.future = future
+
+
+class DeliveryMiddleware(BaseRequestMiddleware):
+    """Шар доставки для всіх запитів бота до Telegram.
+
+    - запити одного чату йдуть строго по черзі, з темпом chat_interval і коротким сплеском;
+    - загальна швидкість обмежена global_rate повідомлень на секунду;
+    - TelegramRetryAfter чекає вказаний час і повторює запит, не порушуючи порядку;
+    - кілька редагувань одного повідомлення, що чекають у черзі, зливаються в одне.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_interval: float = 1.0, chat_burst: int = 3,
+                 group_chat_interval: float = 3.0, max_retries: int = 5):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.group_chat_interval = group_chat_interval
+        self.max_retries = max_retries
+        self._global_tat = 0.0
+        self._chat_tat = {}  # теоретичний час наступного повідомлення в чаті (GCRA)
+        self._chat_locks = {}
+        self._chat_users = {}
+        self._pending_edits = {}
+        self.stats = {
+            "sent": 0,
+            "retried": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    async def _pace(self, chat_id):
+        """Резервує слот для чату (з дозволеним сплеском) і глобально та чекає на нього."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if isinstance(chat_id, int) and chat_id < 0:
+            interval, burst = self.group_chat_interval, 1
+        else:
+            interval, burst = self.chat_interval, self.chat_burst
+        chat_tat = self._chat_tat.get(chat_id, 0.0)
+        at = max(now, chat_tat - (burst - 1) * interval, self._global_tat)
+        self._chat_tat[chat_id] = max(chat_tat, at) + interval
+        self._global_tat = max(self._global_tat, at) + self.global_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _send(self, make_request, bot, method, chat_id):
+        for attempt in range(self.max_retries + 1):
+            if not isinstance(method, UNPACED_METHODS):
+                await self._pace(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.stats["retried"] += 1
+                logging.warning(f"Flood control у чаті {chat_id}: чекаю {e.retry_after} с")
+                # Наступна спроба (і решта повідомлень чату) — не раніше, ніж через retry_after
+                self._chat_tat[chat_id] = asyncio.get_running_loop().time() + e.retry_after + (self.chat_burst - 1) * self.chat_interval
+            except TelegramNetworkError:
+                if attempt >= self.max_retries:
+                    raise
+                self.stats["retried"] += 1
+                await asyncio.sleep(min(2 ** attempt, 10))
+
+    async def _send_in_order(self, make_request, bot, method, chat_id, edit_key=None):
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_users[chat_id] = self._chat_users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                if edit_key is not None:
+                    # Далі нові редагування вже не зливаються з цим — воно надсилається
+                    method = self._pending_edits.pop(edit_key).method
+                return await self._send(make_request, bot, method, chat_id)
+        finally:
+            self._chat_users[chat_id] -= 1
+            if not self._chat_users[chat_id]:
+                del self._chat_users[chat_id]
+                del self._chat_locks[chat_id]
+                if self._chat_tat.get(chat_id, 0.0) <= asyncio.get_running_loop().time():
+                    self._chat_tat.pop(chat_id, None)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        edit_key = pending = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+            queued = self._pending_edits.get(edit_key)
+            if queued is not None:
+                queued.method = method
+                self.stats["coalesced"] += 1
+                return await asyncio.shield(queued.future)
+            pending = self._pending_edits[edit_key] = _PendingEdit(method, loop.create_future())
+
+        try:
+            result = await self._send_in_order(make_request, bot, method, chat_id, edit_key)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                self.stats["dropped"] += 1
+            if pending is not None:
+                if self._pending_edits.get(edit_key) is pending:
+                    del self._pending_edits[edit_key]
+                if isinstance(e, asyncio.CancelledError):
+                    pending.future.cancel()
+                elif not pending.future.done():
+                    pending.future.set_exception(e)
+                    pending.future.exception()  # позначаємо як отримане, якщо ніхто не чекає
+            raise
+
+        if pending is not None and not pending.future.done():
+            pending.future.set_result(result)
+        latency = loop.time() - started_at
+        self.stats["sent"] += 1
+        self.stats["latency_total"] += latency
+        self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+        return result
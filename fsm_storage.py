@@ -0,0 +1,162 @@
+import json
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from metrics import FSM_FLUSH_SECONDS, span
+
+
+class _Record:
+    __slots__ = ("state", "data", "version", "saved_version")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+        self.version = 0
+        self.saved_version = 0
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.saved_version
+
+    def touch(self):
+        self.version += 1
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-сховище на локальному SQLite з кешем у пам'яті.
+
+    Зміни накопичуються в кеші та записуються одним транзакційним flush()
+    (його викликає FSMFlushMiddleware після кожного апдейту).
+    shared=True — файл спільний для кількох процесів: після flush() кеш
+    очищується, тож кожен апдейт читає актуальний стан з диска.
+    """
+
+    def __init__(self, path: str, max_cached: int = 10000, shared: bool = False):
+        self.path = path
+        self.max_cached = max_cached
+        self.shared = shared
+        self._cache = OrderedDict()  # рядковий ключ -> _Record
+        self._flush_lock = asyncio.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30 if shared else 5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(
+            str(part) if part is not None else ""
+            for part in (
+                key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                key.business_connection_id, key.destiny,
+            )
+        )
+
+    def _read(self, db_key: str):
+        with self._db_lock:
+            return self._conn.execute("SELECT state, data FROM fsm WHERE key = ?", (db_key,)).fetchone()
+
+    async def _record(self, key: StorageKey) -> _Record:
+        db_key = self._key(key)
+        record = self._cache.get(db_key)
+        if record is None:
+            row = await asyncio.to_thread(self._read, db_key)
+            # Поки читали з диска, запис міг з'явитися в кеші
+            record = self._cache.get(db_key)
+            if record is None:
+                self._evict()
+                record = _Record(row[0], json.loads(row[1])) if row else _Record()
+                self._cache[db_key] = record
+        self._cache.move_to_end(db_key)
+        return record
+
+    def _evict(self):
+        """Викидає найстаріші збережені записи, поки кеш перевищує ліміт."""
+        if len(self._cache) < self.max_cached:
+            return
+        for db_key in list(self._cache):
+            if len(self._cache) < self.max_cached:
+                break
+            if not self._cache[db_key].dirty:
+                del self._cache[db_key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        record.touch()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = dict(data)
+        record.touch()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._record(key)).data)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        record = await self._record(key)
+        record.data.update(data)
+        record.touch()
+        return dict(record.data)
+
+    def _write(self, rows):
+        with self._db_lock, self._conn:
+            for db_key, state, data in rows:
+                if state is None and not data:
+                    self._conn.execute("DELETE FROM fsm WHERE key = ?", (db_key,))
+                else:
+                    self._conn.execute(
+                        "INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data",
+                        (db_key, state, json.dumps(data, ensure_ascii=False)),
+                    )
+
+    async def flush(self) -> None:
+        """Записує всі накопичені зміни однією транзакцією."""
+        async with self._flush_lock:
+            rows, versions = [], []
+            for db_key, record in self._cache.items():
+                if record.dirty:
+                    rows.append((db_key, record.state, dict(record.data)))
+                    versions.append((record, record.version))
+            if rows:
+                await asyncio.to_thread(self._write, rows)
+            # Записи, змінені під час запису, залишаються "брудними"
+            for record, version in versions:
+                record.saved_version = version
+            if self.shared:
+                for db_key in [db_key for db_key, record in self._cache.items() if not record.dirty]:
+                    del self._cache[db_key]
+
+    async def close(self) -> None:
+        await self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Після обробки апдейту скидає зміни FSM на диск одним записом."""
+
+    def __init__(self, storage: SQLiteStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            with FSM_FLUSH_SECONDS.time(), span("fsm_flush"):
+                await self.storage.flush()
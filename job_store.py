@@ -0,0 +1,219 @@
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from typing import NamedTuple, Optional
+
+# Статуси задачі генерації
+RUNNING = "running"  # генерація почалася, результату ще немає
+DONE = "done"  # результат збережено, доставка могла не завершитися
+DELIVERED = "delivered"
+FAILED = "failed"
+
+
+class GenerationJob(NamedTuple):
+    id: int
+    chat_id: int
+    form_data: dict
+    status: str
+    attempts: int
+    result: Optional[str]
+    created_at: float
+
+
+class BulkRow(NamedTuple):
+    row: int  # номер рядка у завантаженій таблиці
+    form_data: dict
+    status: str
+    result: Optional[str]
+    error: Optional[str]
+
+
+def prompt_key(user_prompt: str) -> str:
+    return hashlib.sha256(user_prompt.encode()).hexdigest()
+
+
+class GenerationJobStore:
+    """Задачі генерації в локальному SQLite: вхідні дані, статус, спроби та результат.
+
+    Після рестарту незавершені задачі можна дочитати через unfinished() і
+    довести до кінця; готові результати повторно віддаються через find_job().
+    Шлях ":memory:" — лише в пам'яті процесу.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, prompt_key TEXT NOT NULL, "
+            "form_data TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_lookup ON jobs (chat_id, prompt_key, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bulk_batches ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, filename TEXT NOT NULL, "
+            "status TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bulk_rows ("
+            "batch_id INTEGER NOT NULL, row INTEGER NOT NULL, form_data TEXT NOT NULL, status TEXT NOT NULL, "
+            "result TEXT, error TEXT, PRIMARY KEY (batch_id, row))"
+        )
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._db_lock, self._conn:
+            return self._conn.execute(sql, params)
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def create(self, chat_id: int, form_data: dict, user_prompt: str) -> int:
+        """Реєструє нову генерацію (одразу зі статусом running і першою спробою)."""
+        now = time.time()
+        cursor = await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO jobs (chat_id, prompt_key, form_data, status, attempts, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 1, ?, ?)",
+            (chat_id, prompt_key(user_prompt), json.dumps(form_data, ensure_ascii=False), RUNNING, now, now),
+        )
+        return cursor.lastrowid
+
+    async def start_attempt(self, job_id: int):
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (RUNNING, time.time(), job_id),
+        )
+
+    async def complete(self, job_id: int, result: str):
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE id = ?",
+            (DONE, result, time.time(), job_id),
+        )
+
+    async def mark_delivered(self, job_id: int):
+        await asyncio.to_thread(
+            self._execute, "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (DELIVERED, time.time(), job_id)
+        )
+
+    async def fail(self, job_id: int, error: str):
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+            (FAILED, error[:1000], time.time(), job_id),
+        )
+
+    async def get(self, job_id: int) -> Optional[GenerationJob]:
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, chat_id, form_data, status, attempts, result, created_at FROM jobs WHERE id = ?",
+            (job_id,),
+        )
+        return self._jobs(rows)[0] if rows else None
+
+    async def find_job(self, chat_id: int, user_prompt: str, max_age: float) -> Optional[GenerationJob]:
+        """Остання задача з готовим результатом для тих самих вхідних даних цього чату (не старша за max_age)."""
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, chat_id, form_data, status, attempts, result, created_at FROM jobs "
+            "WHERE chat_id = ? AND prompt_key = ? AND created_at >= ? "
+            "AND status IN (?, ?) ORDER BY created_at DESC LIMIT 1",
+            (chat_id, prompt_key(user_prompt), time.time() - max_age, DONE, DELIVERED),
+        )
+        return self._jobs(rows)[0] if rows else None
+
+    async def unfinished(self) -> list:
+        """Задачі, які не дійшли до користувача (перервані рестартом)."""
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, chat_id, form_data, status, attempts, result, created_at FROM jobs "
+            "WHERE status IN (?, ?) ORDER BY created_at",
+            (RUNNING, DONE),
+        )
+        return self._jobs(rows)
+
+    @staticmethod
+    def _jobs(rows) -> list:
+        return [
+            GenerationJob(row[0], row[1], json.loads(row[2]), row[3], row[4], row[5], row[6])
+            for row in rows
+        ]
+
+    # --- Пакетна генерація: кожен рядок таблиці зберігається окремо, тож після збою
+    # чи рестарту повторно генеруються лише рядки без результату ---
+    def _insert_batch(self, chat_id: int, filename: str, rows: list) -> int:
+        with self._db_lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO bulk_batches (chat_id, filename, status, created_at) VALUES (?, ?, ?, ?)",
+                (chat_id, filename, RUNNING, time.time()),
+            )
+            self._conn.executemany(
+                "INSERT INTO bulk_rows (batch_id, row, form_data, status) VALUES (?, ?, ?, ?)",
+                [(cursor.lastrowid, row, json.dumps(form_data, ensure_ascii=False), RUNNING) for row, form_data in rows],
+            )
+            return cursor.lastrowid
+
+    async def create_batch(self, chat_id: int, filename: str, rows: list) -> int:
+        """Реєструє пакет; rows — пари (номер рядка, дані форми)."""
+        return await asyncio.to_thread(self._insert_batch, chat_id, filename, rows)
+
+    async def get_batch(self, batch_id: int):
+        """(chat_id, назва файлу, статус) або None."""
+        rows = await asyncio.to_thread(
+            self._query, "SELECT chat_id, filename, status FROM bulk_batches WHERE id = ?", (batch_id,)
+        )
+        return rows[0] if rows else None
+
+    async def batch_rows(self, batch_id: int) -> list:
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT row, form_data, status, result, error FROM bulk_rows WHERE batch_id = ? ORDER BY row",
+            (batch_id,),
+        )
+        return [BulkRow(row[0], json.loads(row[1]), row[2], row[3], row[4]) for row in rows]
+
+    async def save_bulk_row(self, batch_id: int, row: int, result: str = None, error: str = None):
+        """Результат рядка (DONE) або помилка (FAILED)."""
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE bulk_rows SET status = ?, result = ?, error = ? WHERE batch_id = ? AND row = ?",
+            (DONE if error is None else FAILED, result, None if error is None else error[:1000], batch_id, row),
+        )
+
+    async def set_batch_status(self, batch_id: int, status: str):
+        await asyncio.to_thread(self._execute, "UPDATE bulk_batches SET status = ? WHERE id = ?", (status, batch_id))
+
+    async def unfinished_batches(self) -> list:
+        """Пакети, перервані рестартом: (id, chat_id, created_at)."""
+        return await asyncio.to_thread(
+            self._query, "SELECT id, chat_id, created_at FROM bulk_batches WHERE status = ? ORDER BY id", (RUNNING,)
+        )
+
+    async def cleanup(self, max_age: float) -> int:
+        """Видаляє задачі й пакети, старші за max_age секунд; повертає кількість видалених задач."""
+        cutoff = time.time() - max_age
+
+        def delete():
+            with self._db_lock, self._conn:
+                self._conn.execute(
+                    "DELETE FROM bulk_rows WHERE batch_id IN (SELECT id FROM bulk_batches WHERE created_at < ?)", (cutoff,)
+                )
+                self._conn.execute("DELETE FROM bulk_batches WHERE created_at < ?", (cutoff,))
+                return self._conn.execute("DELETE FROM jobs WHERE created_at < ?", (cutoff,)).rowcount
+
+        return await asyncio.to_thread(delete)
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
@@ -0,0 +1,123 @@
+import time
+from collections import deque
+
+from metrics import LLM_CIRCUIT_STATE
+
+
+class LLMUnavailableError(Exception):
+    """Провайдер вважається недоступним (запобіжник розімкнено), запит не надсилався."""
+
+
+class LatencyTracker:
+    """Ковзне вікно тривалостей успішних запитів для оцінки перцентилів."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float):
+        """q-перцентиль (0..1) або None, поки замало даних."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class HedgeBudget:
+    """Обмежує дублюючі запити: не більше ratio від усіх запитів і per_minute за хвилину."""
+
+    def __init__(self, ratio: float = 0.1, per_minute: int = 30):
+        self.ratio = ratio
+        self.per_minute = per_minute
+        self._requests = deque()
+        self._hedges = deque()
+
+    def _trim(self, now: float):
+        for events in (self._requests, self._hedges):
+            while events and now - events[0] > 60:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._hedges) >= self.per_minute or len(self._hedges) + 1 > self.ratio * len(self._requests):
+            return False
+        self._hedges.append(now)
+        return True
+
+
+class CircuitBreaker:
+    """Запобіжник для однієї моделі.
+
+    - closed: запити йдуть; якщо за window секунд було щонайменше min_requests
+      результатів і частка збоїв >= failure_ratio — розмикається;
+    - open: запити не надсилаються cooldown секунд;
+    - half_open: пропускається один пробний запит; успіх замикає, збій знову розмикає.
+    Відповіді 4xx (зокрема 429) не вважаються збоєм — це не проблема доступності.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_ratio: float = 0.5, min_requests: int = 10,
+                 window: float = 60, cooldown: float = 30):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_requests = min_requests
+        self.window = window
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._results = deque()  # (час, успіх)
+        self._opened_at = 0.0
+        self._probe_started_at = None
+        LLM_CIRCUIT_STATE.set(0, name)
+
+    def _set_state(self, state: str):
+        self.state = state
+        LLM_CIRCUIT_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state], self.name)
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.cooldown:
+                return False
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            # Пробний запит, що завис довше за cooldown, не блокує наступну пробу
+            if self._probe_started_at is not None and now - self._probe_started_at < self.cooldown:
+                return False
+            self._probe_started_at = now
+        return True
+
+    def record(self, success: bool):
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self._probe_started_at = None
+            if success:
+                self._results.clear()
+                self._set_state(self.CLOSED)
+            else:
+                self._open(now)
+            return
+        self._results.append((now, success))
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
+        failures = sum(1 for _, ok in self._results if not ok)
+        if (self.state == self.CLOSED and len(self._results) >= self.min_requests
+                and failures >= self.failure_ratio * len(self._results)):
+            self._open(now)
+
+    def release(self):
+        """Пробний запит скасовано без результату — дозволяємо нову пробу."""
+        if self.state == self.HALF_OPEN:
+            self._probe_started_at = None
+
+    def _open(self, now: float):
+        self._opened_at = now
+        self._results.clear()
+        self._set_state(self.OPEN)
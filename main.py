@@ -1,82 +1,254 @@
 import os
-import re
+import sys
+import time
+
+_import_started_at = time.perf_counter()  # для вимірювання холодного старту
 import asyncio
+import hashlib
+import contextlib
 import logging
+import importlib.util
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import ValidationError
 import uvicorn
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     InlineKeyboardButton, InlineKeyboardMarkup,
-    KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+    KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, BufferedInputFile
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
+
+from update_queue import ChatOrderedQueue, update_chat_key
+from dedupe import UpdateDeduplicator
+from wizard import (
+    format_button_label, STEPS, SKIP_STEP_CALLBACK, parse_choice_callback
+)
+from fsm_storage import SQLiteStorage, FSMFlushMiddleware
+from delivery import DeliveryMiddleware
+from rendering import render_post
+from speculation import SpeculativeGenerations, StreamBuffer
+from job_store import GenerationJobStore, RUNNING, DONE, FAILED
+from post_history import PostHistory
+from coordination import LeaderLease, ChatLocks, SharedInFlightGuard, create_shared_state
+from bulk import BULK_EXTENSIONS, BulkFileError, read_table, validate_records, build_result_csv, run_pipeline
+import metrics
+from metrics import (
+    WEBHOOK_SECONDS, UPDATE_SECONDS, HANDLER_SECONDS, VARIANTS_PARSED, VARIANT_PARSE_FALLBACKS,
+    PLAIN_TEXT_FALLBACKS, GENERATIONS_IN_FLIGHT, GENERATION_JOBS, BULK_ROWS, Gauge, render_metrics, span
+)
 
 # --- Завантаження конфігів ---
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # власний Bot API сервер (напр. заглушка бенчмарку)
 
 BASE_WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL", "https://stroyhub-bot.onrender.com")
 WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # X-Telegram-Bot-Api-Secret-Token; без нього заголовок не перевіряється
+
+# Потокова генерація: кожен варіант надсилається, щойно він готовий
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+STREAM_PREVIEW = os.getenv("STREAM_PREVIEW", "0") == "1"
+STREAM_PREVIEW_INTERVAL = float(os.getenv("STREAM_PREVIEW_INTERVAL", "1.5"))  # секунди
+STREAM_PREVIEW_MAX_CHARS = 3500
+
+# Паралельна генерація: кожен варіант окремим запитом (або одним запитом з параметром n)
+LLM_FANOUT = os.getenv("LLM_FANOUT", "0") == "1"
+LLM_FANOUT_USE_N = os.getenv("LLM_FANOUT_USE_N", "0") == "1"
+FANOUT_VARIANT_ATTEMPTS = int(os.getenv("FANOUT_VARIANT_ATTEMPTS", "2"))  # спроби на один варіант
+
+# Фонова обробка апдейтів: вебхук відповідає одразу, апдейти обробляють воркери
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))  # 0 — обробляти прямо у вебхуку
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.getenv("UPDATE_QUEUE_PUT_TIMEOUT", "5"))  # секунди
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "25"))  # секунди
+
+# Відсікання повторних доставок одного апдейту
+DEDUPE_WINDOW = float(os.getenv("DEDUPE_WINDOW", "3600"))  # секунди
+DEDUPE_MAX_IDS = int(os.getenv("DEDUPE_MAX_IDS", "50000"))
+DEDUPE_STATE_PATH = os.getenv("DEDUPE_STATE_PATH")  # файл для збереження між рестартами
+GENERATION_TAP_TTL = 60  # секунди: скільки пам'ятається натискання "згенерувати" на конкретному повідомленні
+
+# Доставка повідомлень: темп на чат і глобально, повтори після flood control
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))  # повідомлень на секунду
+TG_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", "1"))  # секунди між повідомленнями в чаті
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "5"))  # скільки повідомлень можна надіслати без паузи
+TG_GROUP_CHAT_INTERVAL = float(os.getenv("TG_GROUP_CHAT_INTERVAL", "3"))  # секунди, для груп
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+
+# Трасування повільних апдейтів (частка апдейтів, що трасуються; 0 — вимкнено)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "5"))
+
+# Спекулятивна генерація: запуск ще на екрані підсумку та запас для "Згенерувати знову" (лише з одним воркером)
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "0") == "1"
+PREFETCH_REGENERATE = os.getenv("PREFETCH_REGENERATE", "0") == "1"
+SPECULATION_MAX_IN_FLIGHT = int(os.getenv("SPECULATION_MAX_IN_FLIGHT", "4"))
+SPECULATION_TOKENS_PER_HOUR = int(os.getenv("SPECULATION_TOKENS_PER_HOUR", "100000"))  # оцінка токенів
+SPECULATION_CHAT_PER_HOUR = int(os.getenv("SPECULATION_CHAT_PER_HOUR", "6"))
+SPECULATION_TTL = float(os.getenv("SPECULATION_TTL", "600"))  # секунди
+
+# Задачі генерації: переживають рестарт, готовий результат повторно віддається з кешу
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "generation_jobs.sqlite3")  # порожнє значення — лише в пам'яті
+JOB_CACHE_TTL = float(os.getenv("JOB_CACHE_TTL", "3600"))  # секунди; 0 — не відповідати з кешу
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RESUME_MAX_AGE = float(os.getenv("JOB_RESUME_MAX_AGE", "3600"))  # старші перервані задачі не відновлюються
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 24 * 3600)))  # секунди
+JOB_CLEANUP_INTERVAL = 3600  # секунди
+
+# Історія дописів з повнотекстовим пошуком (/history, /search)
+POST_HISTORY_PATH = os.getenv("POST_HISTORY_PATH", "post_history.sqlite3")  # порожнє значення — лише в пам'яті
+HISTORY_PAGE_SIZE = 5
+HISTORY_PREVIEW_CHARS = 120
+
+# --- Пакетна генерація (таблиця об'єктів -> файл з дописами) ---
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "3"))  # одночасні запити одного пакета до LLM
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "200"))
+BULK_MAX_FILE_SIZE = 2 * 1024 * 1024  # байти
+BULK_PROGRESS_INTERVAL = 3  # секунди між оновленнями повідомлення з прогресом
+BULK_ERRORS_SHOWN = 10
+
+# Сховище станів майстра (порожнє значення — лише в пам'яті)
+FSM_STORAGE_PATH = os.getenv("FSM_STORAGE_PATH", "fsm_state.sqlite3")
+
+# --- Кілька воркерів (uvicorn --workers, кількість — WEB_CONCURRENCY) ---
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# "memory" — стан лише в процесі; "sqlite:<файл>" — спільний для воркерів однієї машини
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "memory" if WEB_CONCURRENCY == 1 else "sqlite:shared_state.sqlite3")
+LEADER_LOCK_PATH = os.getenv("LEADER_LOCK_PATH", "bot_leader.lock")
+LEADER_RETRY_INTERVAL = 10  # секунди між спробами стати лідером, якщо лідер уже є
+CHAT_LOCK_TTL = 60  # секунди; поки апдейт обробляється, оренда продовжується
 
 # Логування
 logging.basicConfig(level=logging.INFO)
 
 # --- FastAPI + Aiogram ---
 app = FastAPI()
-bot = Bot(token=TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode="Markdown"))
-dp = Dispatcher()
+startup_timings = {}  # секунди: тривалість імпорту й on_startup, перший оброблений апдейт — від початку імпорту
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TELEGRAM_TOKEN, session=session, default=DefaultBotProperties(parse_mode="Markdown"))
+delivery = DeliveryMiddleware(
+    global_rate=TG_GLOBAL_RATE / WEB_CONCURRENCY,  # ліміт Telegram спільний для всіх воркерів
+    chat_interval=TG_CHAT_INTERVAL,
+    chat_burst=TG_CHAT_BURST,
+    group_chat_interval=TG_GROUP_CHAT_INTERVAL,
+    max_retries=TG_MAX_RETRIES,
+)
+bot.session.middleware(delivery)
+shared_state = create_shared_state(SHARED_STATE_URL)
+chat_locks = ChatLocks(shared_state, ttl=CHAT_LOCK_TTL)
+if shared_state.cross_process and (SPECULATIVE_GENERATION or PREFETCH_REGENERATE):
+    # Спекулятивний результат живе в пам'яті воркера, а підтвердження може прийняти
+    # інший воркер — тоді генерація йде двічі. З кількома воркерами спекуляцію вимкнено.
+    logging.warning("Спекулятивна генерація вимкнена: вона не працює з кількома воркерами")
+    SPECULATIVE_GENERATION = PREFETCH_REGENERATE = False
+leader = LeaderLease(LEADER_LOCK_PATH)
+PROCESS_STARTED_AT = time.time()
+if FSM_STORAGE_PATH:
+    fsm_storage = SQLiteStorage(FSM_STORAGE_PATH, shared=shared_state.cross_process)
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
+else:
+    dp = Dispatcher(storage=MemoryStorage())
 
 
-def format_button_label(text: str, icon: str) -> str:
-    sanitized_text = text.strip()
-    if not sanitized_text:
-        return icon.strip()
+async def process_update(update: types.Update):
+    if not shared_state.cross_process:
+        await _process_update(update)
+        return
+    # Інший воркер може саме обробляти апдейт цього чату — чекаємо на його замок
+    async with chat_locks.hold(update_chat_key(update)):
+        await _process_update(update)
+
+
+async def _process_update(update: types.Update):
+    trace, token = metrics.start_trace(update.update_id, TRACE_SAMPLE_RATE)
+    try:
+        with UPDATE_SECONDS.time():
+            await dp.feed_update(bot=bot, update=update)
+    finally:
+        if trace is not None:
+            metrics.finish_trace(trace, token, TRACE_SLOW_SECONDS)
+        if "first_update_seconds" not in startup_timings:
+            startup_timings["first_update_seconds"] = round(time.perf_counter() - _import_started_at, 4)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Міряє час кожного хендлера (мітка — ім'я функції хендлера)."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        with HANDLER_SECONDS.time(name), span(f"handler:{name}"):
+            return await handler(event, data)
+
 
-    chars = list(sanitized_text)
-    for idx, char in enumerate(chars):
-        if char.isalpha():
-            chars[idx] = char.upper()
-            break
+dp.message.middleware(HandlerTimingMiddleware())
+dp.callback_query.middleware(HandlerTimingMiddleware())
+
+update_queue = ChatOrderedQueue(process_update, workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_SIZE)
+update_dedupe = UpdateDeduplicator(window=DEDUPE_WINDOW, max_size=DEDUPE_MAX_IDS, path=DEDUPE_STATE_PATH)
+generation_guard = SharedInFlightGuard(shared_state, ttl=CHAT_LOCK_TTL)  # генерації й пакети — по одній на чат
+generation_jobs = GenerationJobStore(JOB_STORE_PATH or ":memory:")
+post_history = PostHistory(POST_HISTORY_PATH or ":memory:", page_size=HISTORY_PAGE_SIZE)
+speculation = SpeculativeGenerations(
+    max_in_flight=SPECULATION_MAX_IN_FLIGHT,
+    tokens_per_hour=SPECULATION_TOKENS_PER_HOUR,
+    chat_per_hour=SPECULATION_CHAT_PER_HOUR,
+    ttl=SPECULATION_TTL,
+)
+
+Gauge("bot_update_queue_size", "Апдейти, що чекають або обробляються", func=lambda: update_queue.size)
+Gauge("bot_duplicates_suppressed", "Відкинуті повторні доставки апдейтів", func=lambda: update_dedupe.duplicates_suppressed)
+Gauge("bot_generations_joined", "Повторні натискання, приєднані до генерації", func=lambda: generation_guard.joined)
+Gauge("bot_chat_lock_waits", "Апдейти, що чекали, поки інший воркер звільнить чат", func=lambda: chat_locks.waits)
+Gauge("bot_is_leader", "1 — цей воркер реєструє вебхук і виконує фонові задачі", func=lambda: int(leader.is_leader))
+Gauge("bot_speculations_in_flight", "Спекулятивні генерації, що виконуються зараз", func=lambda: speculation.in_flight)
+for _stat in ("sent", "retried", "coalesced", "dropped", "latency_total", "latency_max"):
+    Gauge(f"bot_delivery_{_stat}", f"Доставка повідомлень: {_stat}", func=lambda stat=_stat: delivery.stats[stat])
 
-    label = ''.join(chars)
-    if icon:
-        return f"{icon} {label}"
-    return label
 
 # --- Імпорт власної логіки ---
-from prompt_logic import build_social_prompt, call_llm
+def lazy_import(name: str):
+    """Модуль, що виконується під час першого звернення до його атрибута, а не під час імпорту."""
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# prompt_logic (разом з httpx) завантажується у фоні після старту або під час першої генерації
+prompt_logic = lazy_import("prompt_logic")
 
 # --- Константи ---
 MAIN_BUTTON_TEXT = format_button_label("Написати новий допис", "📝")
 CANCEL_WIZARD_BUTTON_TEXT = format_button_label("Скасувати створення допису", "❌")
-SKIP_STEP_BUTTON_TEXT = format_button_label("Пропустити", "⏩")
 CONFIRM_GENERATION_BUTTON_TEXT = format_button_label("Згенерувати допис", "✅")
 REGENERATE_BUTTON_TEXT = format_button_label("Згенерувати знову", "🔄")
 FINISH_BUTTON_TEXT = format_button_label("Закінчити", "✅")
 ERROR_RETRY_BUTTON_TEXT = format_button_label("Спробувати знову", "🔄")
 ERROR_FINISH_BUTTON_TEXT = format_button_label("Закінчити", "❌")
-CHOICE_BUTTON_ICON = ""
-
-# --- Кроки ---
-WIZARD_STEPS = [
-    { 'key': 'features',     'type': 'text',   'label': 'Ключові особливості', 'question': "Опишіть про що буде допис" },
-    { 'key': 'platform',     'type': 'choice', 'label': 'Платформа', 'question': "Оберіть платформу.", 'options': ['Instagram', 'Facebook', 'Tik-Tok'] },
-    { 'key': 'objectStatus', 'type': 'choice', 'label': 'Статус об\'єкта', 'question': "Оберіть статус об'єкта.", 'options': ['Об\'єкт зданий', 'Робота в процесі'] },
-    { 'key': 'street',       'type': 'text',   'label': 'Вулиця', 'question': "Вкажіть вулицю (можна пропустити)." },
-    { 'key': 'district',     'type': 'text',   'label': 'Район', 'question': "Вкажіть район (напр: Аркадія)." },
-    { 'key': 'propertyType', 'type': 'choice', 'label': 'Тип нерухомості', 'question': "Оберіть тип нерухомості.", 'options': ['Квартира', 'Апартаменти', 'Будинок', 'Комерційне приміщення'] },
-    { 'key': 'complexName',  'type': 'text',   'label': 'Назва ЖК', 'question': "Вкажіть назву ЖК (можна пропустити)." },
-    { 'key': 'area',         'type': 'text',   'label': 'Площа, м²', 'question': "Яка площа об'єкта в м²?" },
-    { 'key': 'rooms',        'type': 'choice', 'label': 'К-ть кімнат', 'question': "Оберіть кількість кімнат.", 'options': ['1', '2', '3', '4+', 'Студія'] },
-    { 'key': 'goal',         'type': 'choice', 'label': 'Мета тексту', 'question': "Оберіть головну мету тексту.", 'options': ['Продемонструвати якість та деталі', 'Показати експертність', 'Створити емоційний зв\'язок', 'Залучити на консультацію', 'Розповісти історію \"до/після\"'] },
-    { 'key': 'variations',   'type': 'choice', 'label': 'Кількість варіантів допису', 'question': "Скільки варіантів допису згенерувати?", 'options': ['1', '2', '3'] },
-]
+GENERATION_CALLBACKS = {"confirm_generation", "regenerate"}
+GENERATING_TEXT = "⏳ *Генерую допис...*"
+HISTORY_LIST_CALLBACK = "hl:"
+HISTORY_SEARCH_CALLBACK = "hs:"
+HISTORY_RESEND_CALLBACK = "hr:"
+BULK_RETRY_CALLBACK = "br:"
+JOB_RESEND_CALLBACK = "jr:"
 
 # --- FSM ---
 class Form(StatesGroup):
@@ -101,41 +273,27 @@ def wizard_keyboard() -> ReplyKeyboardMarkup:
         resize_keyboard=True
     )
 
-def build_choice_keyboard(options, step_key: str):
-    buttons = [
-        InlineKeyboardButton(
-            text=format_button_label(option, CHOICE_BUTTON_ICON),
-            callback_data=f"select:{step_key}:{idx}"
-        )
-        for idx, option in enumerate(options)
-    ]
-
-    max_label_length = max((len(button.text) for button in buttons), default=0)
-    row_size = 1 if max_label_length > 22 else 2
-
-    return [buttons[i:i + row_size] for i in range(0, len(buttons), row_size)]
-
-
-async def ask_question(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    current_step_index = data.get("current_step_index", 0)
-    if current_step_index >= len(WIZARD_STEPS):
+async def ask_question(message: types.Message, state: FSMContext, step_index: int):
+    if step_index >= len(STEPS):
         await state.set_state(Form.confirm_generation)
         await show_summary(message, state)
         return
-    step = WIZARD_STEPS[current_step_index]
-    if step['type'] == 'choice':
-        keyboard = build_choice_keyboard(step['options'], step['key'])
-    else:
-        keyboard = [[InlineKeyboardButton(text=SKIP_STEP_BUTTON_TEXT, callback_data="skip_step")]]
-    await message.answer(step['question'], reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    step = STEPS[step_index]
+    await message.answer(step.question, reply_markup=step.keyboard)
+
+
+async def advance_wizard(message: types.Message, state: FSMContext, step_index: int, answers: dict = None):
+    """Зберігає відповідь на крок step_index і одразу ставить наступне питання."""
+    next_index = step_index + 1
+    await state.update_data({**(answers or {}), "current_step_index": next_index})
+    await ask_question(message, state, next_index)
 
 async def show_summary(message: types.Message, state: FSMContext):
     data = await state.get_data()
     summary_lines = ["Дякую! Ви заповнили всі дані:", ""]
-    for step in WIZARD_STEPS:
-        answer = data.get(step['key'], "пропущено")
-        summary_lines.append(f"{step['label']}: {answer}")
+    for step in STEPS:
+        answer = data.get(step.key, "пропущено")
+        summary_lines.append(f"{step.label}: {answer}")
         summary_lines.append("")
     summary_text = "\n".join(summary_lines).strip()
     await message.answer(summary_text, parse_mode=None)
@@ -143,52 +301,614 @@ async def show_summary(message: types.Message, state: FSMContext):
         inline_keyboard=[[InlineKeyboardButton(text=CONFIRM_GENERATION_BUTTON_TEXT, callback_data="confirm_generation")]]
     )
     await message.answer("Перевірте введені дані", reply_markup=confirm_keyboard)
+    if SPECULATIVE_GENERATION:
+        prompt = prompt_logic.compile_prompt(data)
+        # Ті самі дані вже генерувались — підтвердження візьме відповідь з кешу, LLM не потрібна
+        if await cached_job(message.chat.id, prompt) is None:
+            start_speculation(message.chat.id, prompt, "summary")
 
 
-async def generate_posts(message: types.Message, state: FSMContext, is_regenerate: bool = False):
-    data = await state.get_data()
-    await state.set_state(Form.confirm_generation)
-    await message.answer("⏳ *Генерую допис...*", reply_markup=ReplyKeyboardRemove())
+async def cached_job(chat_id: int, prompt):
+    """Задача зі збереженою відповіддю на цей самий промпт (за JOB_CACHE_TTL) або None."""
+    if JOB_CACHE_TTL <= 0:
+        return None
+    return await generation_jobs.find_job(chat_id, prompt.user_prompt, JOB_CACHE_TTL)
+
+
+def start_speculation(chat_id: int, prompt, kind: str):
+    """Починає генерацію у фоні; результат забере generate_posts, якщо промпт не зміниться.
+
+    З LLM_STREAMING відповідь читається потоком у StreamBuffer, тож підтвердження
+    посеред генерації одразу показує готові варіанти, а решту — наживо.
+    """
+    if LLM_STREAMING:
+        stream = StreamBuffer()
+        factory = lambda: stream.fill(prompt_logic.stream_llm(
+            prompt.system_prompt, prompt.user_prompt, chat_id=chat_id, max_tokens=prompt.max_tokens
+        ))
+    else:
+        stream = None
+        factory = lambda: prompt_logic.call_llm(
+            prompt.system_prompt, prompt.user_prompt, chat_id=chat_id, max_tokens=prompt.max_tokens
+        )
+    speculation.start(chat_id, prompt.user_prompt, prompt.estimated_tokens, factory, kind=kind, stream=stream)
+
+
+async def take_speculative_result(chat_id: int, prompt):
+    """Спекулятивний результат для цього промпту: готовий текст, незавершений StreamBuffer або None."""
+    taken = speculation.take(chat_id, prompt.user_prompt)
+    if taken is None:
+        return None
+    if taken.stream is not None and not taken.task.done():
+        return taken.stream
     try:
-        system_prompt, user_prompt = build_social_prompt(data)
-        result_string = await call_llm(system_prompt, user_prompt)
-        result_string = result_string.replace("—", "-")
+        return await taken.task
+    except Exception as e:
+        logging.info(f"Спекулятивний результат недоступний, генерую заново: {e}")
+        return None
+
+
+async def send_post(chat_id: int, post: str):
+    """Надсилає допис у HTML, поділений на повідомлення до 4096 символів.
+
+    Частину, яку Telegram не прийняв, повторює простим текстом — без нової генерації.
+    """
+    for chunk in render_post(post):
+        try:
+            await bot.send_message(chat_id, chunk.html, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            logging.warning(f"Telegram не прийняв розмітку допису, надсилаю простим текстом: {e}")
+            PLAIN_TEXT_FALLBACKS.inc()
+            await bot.send_message(chat_id, chunk.plain, parse_mode=None)
+
+
+async def stream_posts(message: types.Message, placeholder: types.Message, prompt, on_queue=None, chunks=None):
+    """Надсилає варіанти по мірі генерації; повертає (варіанти, повний текст).
+
+    chunks — уже запущений потік фрагментів (спекулятивної генерації) замість нового запиту до моделі.
+
+    Готові варіанти надсилає окрема задача: доставка розтягнута в часі (DeliveryMiddleware),
+    а потік моделі має читатися без пауз, щоб слот планувальника LLM і з'єднання
+    звільнялися, щойно модель закінчила.
+    """
+    parser = prompt_logic.VariantStreamParser()
+    posts = []
+    outbox = asyncio.Queue()  # варіанти для надсилання; None — потік закінчився
+    loop = asyncio.get_running_loop()
+    last_preview_at = loop.time()
+    preview_shown = False
+    preview_task = None
+
+    def enqueue(completed):
+        for post in completed:
+            post = post.replace("—", "-")
+            posts.append(post)
+            outbox.put_nowait(post)
+
+    async def send_completed():
+        while (post := await outbox.get()) is not None:
+            await send_post(message.chat.id, post)
+
+    async def show_preview(preview: str):
+        nonlocal preview_shown
+        try:
+            await placeholder.edit_text(
+                "⏳ " + render_post(preview[-STREAM_PREVIEW_MAX_CHARS:])[-1].html, parse_mode="HTML"
+            )
+            preview_shown = True
+        except Exception as e:
+            logging.debug(f"Не вдалося оновити попередній перегляд: {e}")
+
+    sender = asyncio.create_task(send_completed())
+    try:
+        try:
+            if chunks is None:
+                chunks = prompt_logic.stream_llm(
+                    prompt.system_prompt, prompt.user_prompt,
+                    chat_id=message.chat.id, on_queue=on_queue, max_tokens=prompt.max_tokens
+                )
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    enqueue(parser.feed(chunk))
+                    if sender.done():
+                        break  # надсилання впало — далі генерувати нема для кого
+                    # Попередній перегляд не чекаємо: поки редагування не завершилося, нове не починаємо
+                    preview_idle = preview_task is None or preview_task.done()
+                    if STREAM_PREVIEW and preview_idle and loop.time() - last_preview_at >= STREAM_PREVIEW_INTERVAL:
+                        last_preview_at = loop.time()
+                        preview = parser.pending().strip()
+                        if preview:
+                            preview_task = asyncio.create_task(show_preview(preview))
+            if not sender.done():
+                enqueue(parser.finish())
+        except Exception:
+            # Потік обірвався — уже готові варіанти все одно доходять до користувача, потім помилка йде далі
+            outbox.put_nowait(None)
+            await asyncio.gather(sender, return_exceptions=True)
+            raise
+        outbox.put_nowait(None)
+        await sender
+        if preview_task is not None:
+            await preview_task
+    finally:
+        sender.cancel()
+        if preview_task is not None:
+            preview_task.cancel()
+
+    if preview_shown:
+        try:
+            await placeholder.delete()
+        except Exception:
+            pass
+    return posts, parser.text.replace("—", "-")
+
 
-        pattern = r'(## Варіант \d+.*?)(?=\n## Варіант \d+|\Z)'
-        posts = re.findall(pattern, result_string, flags=re.S)
-        posts = [post.strip() for post in posts if post.strip()]
+async def send_posts(chat_id: int, result_string: str):
+    """Надсилає варіанти з готової відповіді; повертає (варіанти, повний текст)."""
+    result_string = result_string.replace("—", "-")
+    posts = prompt_logic.split_variants(result_string)
+    for post in posts:
+        await send_post(chat_id, post)
+    return posts, result_string
+
+
+async def generate_variant(chat_id: int, number: int, prompt, on_queue=None) -> str:
+    """Один варіант окремим запитом; невдалі або порожні відповіді повторюються."""
+    last_error = None
+    for attempt in range(FANOUT_VARIANT_ATTEMPTS):
+        try:
+            result = await prompt_logic.call_llm(
+                prompt.system_prompt, prompt.user_prompt,
+                chat_id=chat_id, on_queue=on_queue, max_tokens=prompt.max_tokens
+            )
+        except Exception as e:
+            last_error = e
+            continue
+        post = prompt_logic.number_variant(result, number)
+        if post:
+            return post
+        last_error = Exception("модель повернула порожній варіант")
+    raise last_error
+
+
+async def fanout_posts(message: types.Message, data: dict, on_queue=None):
+    """Генерує варіанти паралельно й надсилає кожен, щойно він готовий; повертає (варіанти, повний текст).
+
+    Варіант, що не вдався, не скасовує решту — користувач отримує всі успішні.
+    """
+    chat_id = message.chat.id
+    prompts = prompt_logic.compile_variant_prompts(data)
+    if LLM_FANOUT_USE_N:
+        prompt = prompt_logic.compile_prompt({**data, "variations": "1"})
+        results = await prompt_logic.call_llm_choices(
+            prompt.system_prompt, prompt.user_prompt,
+            chat_id=chat_id, on_queue=on_queue, max_tokens=prompt.max_tokens, n=len(prompts)
+        )
+        posts = [
+            post for number, result in enumerate(results, 1) if (post := prompt_logic.number_variant(result, number))
+        ]
+        return await send_posts(chat_id, "\n\n".join(posts))
+
+    # Позицію в черзі показуємо лише для першого варіанта, щоб не дублювати редагування
+    tasks = [
+        asyncio.create_task(generate_variant(chat_id, number, prompt, on_queue if number == 1 else None))
+        for number, prompt in enumerate(prompts, 1)
+    ]
+    posts, errors = [], []
+    try:
+        for next_post in asyncio.as_completed(tasks):
+            try:
+                post = (await next_post).replace("—", "-")
+            except Exception as e:
+                errors.append(e)
+                continue
+            posts.append(post)
+            await send_post(message.chat.id, post)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if errors:
+        logging.warning(f"Не вдалося згенерувати {len(errors)} з {len(prompts)} варіантів: {errors[0]}")
         if not posts:
-            await message.answer("Не вдалося розпізнати варіанти.\n\n" + result_string)
-        else:
-            for post in posts:
-                await message.answer(post)
-        
-        final_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=REGENERATE_BUTTON_TEXT, callback_data="regenerate"),
-             InlineKeyboardButton(text=FINISH_BUTTON_TEXT, callback_data="finish_generation")]
-        ])
-        await message.answer("Що робимо далі?", reply_markup=final_keyboard)
+            raise errors[0]
+        await message.answer(f"⚠️ Не вдалося згенерувати варіантів: {len(errors)} з {len(prompts)}.")
+    return posts, "\n\n".join(posts)
+
+
+async def generate_posts(message: types.Message, data: dict, is_regenerate: bool = False):
+    GENERATIONS_IN_FLIGHT.inc()
+    try:
+        with span("generate_posts"):
+            await _generate_posts(message, data, is_regenerate)
+    finally:
+        GENERATIONS_IN_FLIGHT.dec()
+
+
+def final_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=REGENERATE_BUTTON_TEXT, callback_data="regenerate"),
+         InlineKeyboardButton(text=FINISH_BUTTON_TEXT, callback_data="finish_generation")]
+    ])
+
+
+def error_keyboard(resend_job_id: int = None) -> InlineKeyboardMarkup:
+    """resend_job_id — результат уже збережено, тож "Спробувати знову" лише надсилає його повторно."""
+    retry_callback = "regenerate" if resend_job_id is None else f"{JOB_RESEND_CALLBACK}{resend_job_id}"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=ERROR_RETRY_BUTTON_TEXT, callback_data=retry_callback),
+         InlineKeyboardButton(text=ERROR_FINISH_BUTTON_TEXT, callback_data="finish_generation")]
+    ])
+
+
+async def finish_delivery(chat_id: int, posts: list, result_string: str, form_data: dict = None):
+    """Після надсилання варіантів: метрики, історія, сирий текст, якщо варіанти не розпізнано, і кнопки.
+
+    form_data=None — дописи вже є в історії (відповідь з кешу), повторно не записуються.
+    """
+    VARIANTS_PARSED.inc(amount=len(posts))
+    if form_data is not None and posts:
+        post_history.record(chat_id, form_data, posts)
+    if not posts:
+        VARIANT_PARSE_FALLBACKS.inc()
+        await send_post(chat_id, "Не вдалося розпізнати варіанти.\n\n" + result_string)
+    await bot.send_message(chat_id, "Що робимо далі?", reply_markup=final_keyboard())
+
+
+async def report_generation_error(chat_id: int, error: Exception, resend_job_id: int = None):
+    if resend_job_id is None:
+        await bot.send_message(chat_id, f"❌ Під час генерації сталася помилка: {error}", parse_mode=None)
+        await bot.send_message(chat_id, "Спробувати згенерувати ще раз?", reply_markup=error_keyboard())
+    else:
+        await bot.send_message(chat_id, f"❌ Дописи готові, але не вдалося їх надіслати: {error}", parse_mode=None)
+        await bot.send_message(chat_id, "Надіслати їх ще раз?", reply_markup=error_keyboard(resend_job_id))
+
+
+async def _generate_posts(message: types.Message, data: dict, is_regenerate: bool = False):
+    chat_id = message.chat.id
+    placeholder = await message.answer(GENERATING_TEXT, reply_markup=ReplyKeyboardRemove())
+
+    async def show_queue_position(position: int):
+        await placeholder.edit_text(f"{GENERATING_TEXT}\n\nВаша позиція в черзі: {position}")
+
+    job_id = stored_job_id = None  # stored_job_id — задача, результат якої вже збережено
+    try:
+        prompt = prompt_logic.compile_prompt(data)
+        posts = result_string = None
+        cached = None if is_regenerate else await cached_job(chat_id, prompt)
+        if cached is not None:
+            # Повторне підтвердження тих самих даних — відповідь зі сховища, без LLM
+            stored_job_id, result_string = cached.id, cached.result
+            GENERATION_JOBS.inc("cached")
+            speculation.cancel(chat_id)
+        if result_string is None:
+            job_id = await generation_jobs.create(chat_id, data, prompt.user_prompt)
+            GENERATION_JOBS.inc("created")
+            speculative = await take_speculative_result(chat_id, prompt)
+            if isinstance(speculative, StreamBuffer):
+                # Спекуляція ще генерується: готові варіанти — одразу, решта — наживо з того самого потоку
+                try:
+                    posts, result_string = await stream_posts(
+                        message, placeholder, prompt, chunks=speculative.replay()
+                    )
+                except Exception as e:
+                    if speculative.chunks:
+                        raise  # частину відповіді вже показано — повторна генерація її задублює
+                    logging.info(f"Спекулятивна генерація не вдалася, генерую заново: {e}")
+            else:
+                result_string = speculative
+            if result_string is None and LLM_FANOUT and prompt_logic.parse_variations(data.get("variations", "1")) > 1:
+                posts, result_string = await fanout_posts(message, data, on_queue=show_queue_position)
+            elif result_string is None and LLM_STREAMING:
+                posts, result_string = await stream_posts(message, placeholder, prompt, on_queue=show_queue_position)
+            elif result_string is None:
+                result_string = await prompt_logic.call_llm(
+                    prompt.system_prompt, prompt.user_prompt,
+                    chat_id=chat_id, on_queue=show_queue_position, max_tokens=prompt.max_tokens
+                )
+            await generation_jobs.complete(job_id, result_string)
+            stored_job_id = job_id
+        if posts is None:
+            posts, result_string = await send_posts(chat_id, result_string)
+        # Відповідь з кешу вже в історії, якщо її колись доставили
+        await finish_delivery(chat_id, posts, result_string, data if cached is None or cached.status == DONE else None)
+        await generation_jobs.mark_delivered(stored_job_id)
+        if PREFETCH_REGENERATE and posts:
+            start_speculation(chat_id, prompt, "prefetch")
     except Exception as e:
-        await message.answer(f"❌ Під час генерації сталася помилка: {e}")
-        final_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=ERROR_RETRY_BUTTON_TEXT, callback_data="regenerate"),
-             InlineKeyboardButton(text=ERROR_FINISH_BUTTON_TEXT, callback_data="finish_generation")]
-        ])
-        await message.answer("Спробувати згенерувати ще раз?", reply_markup=final_keyboard)
+        # Збережений результат лишається DONE: його віддасть кеш, рестарт або кнопка повторного надсилання
+        if job_id is not None and stored_job_id is None:
+            await generation_jobs.fail(job_id, str(e))
+            GENERATION_JOBS.inc("failed")
+        await report_generation_error(chat_id, e, stored_job_id)
+
+
+async def resend_job(job):
+    """Повторно надсилає збережений результат задачі, доставка якого не вдалася, — без нової генерації."""
+    try:
+        posts, result_string = await send_posts(job.chat_id, job.result)
+        # Доставлену раніше задачу вже записано в історію
+        await finish_delivery(job.chat_id, posts, result_string, job.form_data if job.status == DONE else None)
+        await generation_jobs.mark_delivered(job.id)
+    except Exception as e:
+        logging.warning(f"Не вдалося повторно надіслати результат задачі {job.id}: {e}")
+        try:
+            await report_generation_error(job.chat_id, e, job.id)
+        except Exception:
+            pass
+
+
+async def resume_job(job):
+    """Доводить перервану рестартом задачу до кінця і надсилає результат у її чат."""
+    try:
+        result_string = job.result
+        if result_string is None:
+            await generation_jobs.start_attempt(job.id)
+            prompt = prompt_logic.compile_prompt(job.form_data)
+            result_string = await prompt_logic.call_llm(
+                prompt.system_prompt, prompt.user_prompt, chat_id=job.chat_id, max_tokens=prompt.max_tokens
+            )
+            await generation_jobs.complete(job.id, result_string)
+            job = job._replace(status=DONE, result=result_string)
+        await bot.send_message(job.chat_id, "🔄 Бот перезапускався під час генерації — ось ваші дописи:")
+        posts, result_string = await send_posts(job.chat_id, result_string)
+        await finish_delivery(job.chat_id, posts, result_string, job.form_data)
+        await generation_jobs.mark_delivered(job.id)
+    except Exception as e:
+        logging.exception(f"Не вдалося відновити задачу генерації {job.id}")
+        if job.result is None:
+            await generation_jobs.fail(job.id, str(e))
+            GENERATION_JOBS.inc("failed")
+        try:
+            await report_generation_error(job.chat_id, e, job.id if job.result is not None else None)
+        except Exception:
+            pass
+
+
+async def resume_generation_jobs():
+    """Підхоплює задачі, перервані рестартом (запускається з on_startup)."""
+    for job in await generation_jobs.unfinished():
+        if job.created_at >= PROCESS_STARTED_AT:
+            continue  # задачу створив уже цей запуск (інший воркер) — вона виконується
+        if time.time() - job.created_at > JOB_RESUME_MAX_AGE or (job.status == RUNNING and job.attempts >= JOB_MAX_ATTEMPTS):
+            await generation_jobs.fail(job.id, "не відновлено після рестарту")
+            GENERATION_JOBS.inc("failed")
+            continue
+        GENERATION_JOBS.inc("resumed")
+        asyncio.create_task(generation_guard.run(job.chat_id, lambda job=job: resume_job(job)))
+
+
+async def cleanup_generation_jobs():
+    while True:
+        try:
+            removed = await generation_jobs.cleanup(JOB_RETENTION)
+            if removed:
+                logging.info(f"Видалено старих задач генерації: {removed}")
+            await shared_state.cleanup()
+        except Exception:
+            logging.exception("Не вдалося очистити старі задачі генерації")
+        await asyncio.sleep(JOB_CLEANUP_INTERVAL)
+
+
+def bulk_progress_text(done: int, total: int, failed: int) -> str:
+    filled = round(10 * done / total) if total else 10
+    text = f"📦 Пакетна генерація: {done} з {total}\n{'▓' * filled}{'░' * (10 - filled)}"
+    if failed:
+        text += f"\n⚠️ Помилок: {failed}"
+    return text
+
+
+async def run_bulk_batch(chat_id: int, batch_id: int):
+    """Генерує дописи для рядків пакета, які ще не мають результату, і надсилає файл з усіма результатами.
+
+    Рядки йдуть через той самий планувальник LLM (черга чату, ліміти RPM/TPM), а
+    BULK_CONCURRENCY обмежує, скільки слотів пакет займає одночасно, тож інші
+    користувачі не чекають, поки пакет закінчиться.
+    """
+    rows = await generation_jobs.batch_rows(batch_id)
+    pending = [row for row in rows if row.status != DONE]
+    already_done = len(rows) - len(pending)
+    progress = await bot.send_message(chat_id, bulk_progress_text(already_done, len(rows), 0), parse_mode=None)
+    started_at = last_progress_at = time.monotonic()
+
+    async def generate_row(row):
+        prompt = prompt_logic.compile_prompt(row.form_data)
+        try:
+            result_string = await prompt_logic.call_llm(
+                prompt.system_prompt, prompt.user_prompt, chat_id=chat_id, max_tokens=prompt.max_tokens
+            )
+        except Exception as e:
+            BULK_ROWS.inc("failed")
+            await generation_jobs.save_bulk_row(batch_id, row.row, error=str(e) or type(e).__name__)
+            raise
+        result_string = result_string.replace("—", "-")
+        BULK_ROWS.inc("done")
+        await generation_jobs.save_bulk_row(batch_id, row.row, result=result_string)
+        post_history.record(chat_id, row.form_data, prompt_logic.split_variants(result_string) or [result_string])
+
+    async def show_progress(done: int, failed: int):
+        nonlocal last_progress_at
+        now = time.monotonic()
+        if done < len(pending) and now - last_progress_at < BULK_PROGRESS_INTERVAL:
+            return
+        last_progress_at = now
+        try:
+            await bot.edit_message_text(
+                bulk_progress_text(already_done + done, len(rows), failed),
+                chat_id=chat_id, message_id=progress.message_id, parse_mode=None,
+            )
+        except Exception as e:
+            # Прогрес — лише підказка: збій редагування не зупиняє пакет
+            logging.debug(f"Не вдалося оновити прогрес пакета {batch_id}: {e}")
+
+    failed = await run_pipeline(pending, generate_row, BULK_CONCURRENCY, show_progress)
+    elapsed = time.monotonic() - started_at
+    rows_per_minute = (len(pending) - failed) / elapsed * 60 if elapsed > 0 else 0.0
+    logging.info(
+        f"Пакет {batch_id}: {len(pending) - failed} з {len(pending)} рядків за {elapsed:.1f} с "
+        f"({rows_per_minute:.1f} рядків/хв)"
+    )
+
+    rows = await generation_jobs.batch_rows(batch_id)
+    document = build_result_csv([(row.row, row.form_data, row.status, row.result, row.error) for row in rows])
+    done = sum(1 for row in rows if row.status == DONE)
+    caption = (
+        f"{'✅' if not failed else '⚠️'} Готово: {done} з {len(rows)} рядків.\n"
+        f"Час: {elapsed / 60:.1f} хв, швидкість: {rows_per_minute:.1f} рядків/хв."
+    )
+    await bot.send_document(
+        chat_id, BufferedInputFile(document, filename=f"posts_{batch_id}.csv"), caption=caption, parse_mode=None
+    )
+    await generation_jobs.set_batch_status(batch_id, FAILED if failed else DONE)
+    if failed:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=format_button_label(f"Повторити невдалі ({failed})", "🔄"),
+                                 callback_data=f"{BULK_RETRY_CALLBACK}{batch_id}")
+        ]])
+        await bot.send_message(
+            chat_id, "Частину рядків не вдалося згенерувати — причини в колонці error.", reply_markup=keyboard
+        )
+
+
+async def start_bulk_batch(chat_id: int, batch_id: int):
+    """Запускає пакет у фоні (один пакет на чат), щоб не тримати чергу апдейтів чату."""
+    async def run():
+        try:
+            await run_bulk_batch(chat_id, batch_id)
+        except Exception as e:
+            logging.exception(f"Пакетна генерація {batch_id} завершилася з помилкою")
+            try:
+                await bot.send_message(chat_id, f"❌ Пакетна генерація перервалася: {e}", parse_mode=None)
+            except Exception:
+                pass
+
+    if await generation_guard.is_running_anywhere(("bulk", chat_id)):
+        await bot.send_message(chat_id, "⏳ Пакетна генерація вже триває — дочекайтеся файлу з результатами.")
+        return
+    asyncio.create_task(generation_guard.run(("bulk", chat_id), run))
+
+
+async def resume_bulk_batches():
+    """Продовжує пакети, перервані рестартом: генеруються лише рядки без результату."""
+    for batch_id, chat_id, created_at in await generation_jobs.unfinished_batches():
+        if created_at >= PROCESS_STARTED_AT:
+            continue
+        if time.time() - created_at > JOB_RESUME_MAX_AGE:
+            await generation_jobs.set_batch_status(batch_id, FAILED)
+            continue
+        await bot.send_message(chat_id, "🔄 Бот перезапускався — продовжую пакетну генерацію.")
+        await start_bulk_batch(chat_id, batch_id)
+
+
+async def start_generation(message: types.Message, state: FSMContext, is_regenerate: bool = False):
+    """Запускає генерацію у фоні (одна на чат) і не тримає воркер черги апдейтів.
+
+    Генерація триває десятки секунд: якби її чекав воркер ChatOrderedQueue, кілька
+    одночасних генерацій зупинили б апдейти всіх інших чатів, навіть кроки майстра.
+    Стан майстра читається тут, поки апдейти чату ще йдуть по черзі.
+    """
+    data = await state.get_data()
+    await state.set_state(Form.confirm_generation)
+    asyncio.create_task(
+        generation_guard.run(message.chat.id, lambda: generate_posts(message, data, is_regenerate))
+    )
+
+
+async def confirm_generation(call: types.CallbackQuery, state: FSMContext):
+    await call.message.edit_reply_markup()
+    await start_generation(call.message, state)
+
+
+async def regenerate(call: types.CallbackQuery, state: FSMContext):
+    await call.message.delete()
+    await start_generation(call.message, state, is_regenerate=True)
+
+
+def generation_tap_key(update: types.Update):
+    """Ключ натискання "згенерувати" (чат + повідомлення з кнопкою) або None для інших апдейтів."""
+    call = update.callback_query
+    if call is None or call.message is None:
+        return None
+    if call.data not in GENERATION_CALLBACKS and not (call.data or "").startswith(JOB_RESEND_CALLBACK):
+        return None
+    return f"tap:{call.message.chat.id}:{call.message.message_id}"
+
+
+async def is_duplicate_generation_tap(update: types.Update) -> bool:
+    """Натискання "згенерувати", поки для цього чату вже йде генерація, або повторне на ту саму кнопку.
+
+    Натискання позначається ще на вході вебхука, до черги апдейтів: генерацію guard
+    реєструє лише тоді, коли до апдейту дійде черга чату, і друге натискання, що
+    прийшло раніше, інакше стало б за першим у черзі й запустило другу генерацію.
+    Кнопку генерації після натискання прибрано, тож те саме повідомлення законно
+    натискають лише раз.
+    """
+    tap_key = generation_tap_key(update)
+    if tap_key is None:
+        return False
+    if await generation_guard.is_running_anywhere(update.callback_query.message.chat.id):
+        return True
+    return not await shared_state.add_if_absent(tap_key, GENERATION_TAP_TTL)
+
+
+async def answer_duplicate_tap(call: types.CallbackQuery):
+    try:
+        await call.answer("⏳ Генерація вже триває")
+    except Exception as e:
+        logging.debug(f"Не вдалося відповісти на повторне натискання: {e}")
+
+def format_history_page(title: str, posts: list, page: int, has_next: bool, page_callback: str):
+    """Текст і кнопки сторінки історії: короткий опис кожного допису, повторне надсилання, гортання."""
+    lines = [f"{title} (сторінка {page + 1}):", ""]
+    for post in posts:
+        meta = [time.strftime("%d.%m.%Y", time.localtime(post.created_at))]
+        meta += [post.form_data[key] for key in ("platform", "district", "complexName") if post.form_data.get(key)]
+        body = post.text.split("\n", 1)[-1].strip().replace("\n", " ")
+        preview = body[:HISTORY_PREVIEW_CHARS] + ("…" if len(body) > HISTORY_PREVIEW_CHARS else "")
+        lines.append(f"#{post.id} · {' · '.join(meta)}\n{preview}")
+        lines.append("")
+    rows = [[InlineKeyboardButton(text=f"📤 #{post.id}", callback_data=f"{HISTORY_RESEND_CALLBACK}{post.id}") for post in posts]]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"{page_callback}{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"{page_callback}{page + 1}"))
+    if navigation:
+        rows.append(navigation)
+    return "\n".join(lines).strip(), InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def show_history_page(message: types.Message, owner_id: int, page: int, query: str = None, edit: bool = False):
+    if query:
+        posts, has_next = await post_history.search(owner_id, query, page)
+        title, page_callback = f"Знайдено за запитом «{query}»", HISTORY_SEARCH_CALLBACK
+    else:
+        posts, has_next = await post_history.latest(owner_id, page)
+        title, page_callback = "Ваші дописи", HISTORY_LIST_CALLBACK
+    if not posts:
+        text, keyboard = ("Нічого не знайдено." if query else "Історія дописів поки порожня."), None
+    else:
+        text, keyboard = format_history_page(title, posts, page, has_next, page_callback)
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard, parse_mode=None)
+    else:
+        await message.answer(text, reply_markup=keyboard, parse_mode=None)
 
 # --- Хендлери ---
 @dp.message(F.text.in_({"/start", "/newpost", MAIN_BUTTON_TEXT}))
 async def command_start_handler(message: types.Message, state: FSMContext):
+    speculation.cancel(message.chat.id)
     await state.clear()
     await state.set_data({"current_step_index": 0})
     await state.set_state(Form.in_wizard)
     await message.answer("👋 Вітаю! Давайте створимо допис.", reply_markup=wizard_keyboard())
-    await ask_question(message, state)
+    await ask_question(message, state, 0)
 
 @dp.message(F.text.lower() == CANCEL_WIZARD_BUTTON_TEXT.lower())
 async def cancel_wizard_via_button(message: types.Message, state: FSMContext):
     if await state.get_state() not in {Form.in_wizard, Form.confirm_generation}:
         return
+    speculation.cancel(message.chat.id)
     await state.clear()
     await message.answer("❌ Створення допису скасовано.", reply_markup=ReplyKeyboardRemove())
     await send_main_menu(message)
@@ -197,19 +917,131 @@ async def cancel_wizard_via_button(message: types.Message, state: FSMContext):
 async def cancel_handler(message: types.Message, state: FSMContext):
     if await state.get_state() is None:
         return
+    speculation.cancel(message.chat.id)
     await state.clear()
     await message.answer("Дію скасовано.")
     await send_main_menu(message)
 
+@dp.message(Command("history"))
+async def history_handler(message: types.Message):
+    await show_history_page(message, message.chat.id, 0)
+
+@dp.message(Command("search"))
+async def search_handler(message: types.Message, state: FSMContext):
+    query = (message.text or "").partition(" ")[2].strip()
+    if not query:
+        await message.answer("Напишіть, що шукати, наприклад: /search Печерський ЖК Сонячний", parse_mode=None)
+        return
+    await state.update_data({"history_query": query})
+    await show_history_page(message, message.chat.id, 0, query)
+
+@dp.message(Command("bulk"))
+async def bulk_help_handler(message: types.Message):
+    columns = "\n".join(
+        f"• {step.key} — {step.label}" + (f" ({' / '.join(step.options)})" if step.options else "")
+        for step in STEPS
+    )
+    await message.answer(
+        "📦 Пакетна генерація: надішліть файл .csv або .xlsx, де кожен рядок — окремий об'єкт.\n"
+        "Назви колонок — ключі або підписи полів; поля з варіантами обов'язкові, решту можна лишити порожніми:\n\n"
+        f"{columns}\n\n"
+        f"Не більше {BULK_MAX_ROWS} рядків. У відповідь прийде один CSV-файл з дописами для всіх рядків.",
+        parse_mode=None,
+    )
+
+@dp.message(F.document)
+async def bulk_upload_handler(message: types.Message):
+    document = message.document
+    filename = document.file_name or ""
+    if not filename.lower().endswith(BULK_EXTENSIONS):
+        await message.answer("Для пакетної генерації надішліть файл .csv або .xlsx (деталі — /bulk).")
+        return
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+        await message.answer(f"Файл завеликий: максимум {BULK_MAX_FILE_SIZE // 1024} КБ.")
+        return
+    chat_id = message.chat.id
+    if await generation_guard.is_running_anywhere(("bulk", chat_id)):
+        await message.answer("⏳ Пакетна генерація вже триває — дочекайтеся файлу з результатами.")
+        return
+
+    try:
+        content = (await bot.download(document)).read()
+        rows, errors = validate_records(await asyncio.to_thread(read_table, filename, content))
+    except BulkFileError as e:
+        await message.answer(f"❌ {e}", parse_mode=None)
+        return
+    if errors:
+        shown = "\n".join(errors[:BULK_ERRORS_SHOWN])
+        more = f"\n…і ще {len(errors) - BULK_ERRORS_SHOWN}" if len(errors) > BULK_ERRORS_SHOWN else ""
+        await message.answer(f"❌ Файл містить помилки, виправте їх і надішліть знову:\n\n{shown}{more}", parse_mode=None)
+        return
+    if len(rows) > BULK_MAX_ROWS:
+        await message.answer(f"❌ Забагато рядків: {len(rows)}, максимум {BULK_MAX_ROWS}.")
+        return
+
+    batch_id = await generation_jobs.create_batch(chat_id, filename, rows)
+    await start_bulk_batch(chat_id, batch_id)
+
+@dp.callback_query(F.data.startswith(BULK_RETRY_CALLBACK))
+async def bulk_retry_callback(call: types.CallbackQuery):
+    try:
+        await call.answer()
+    except Exception:
+        pass
+    value = call.data.partition(":")[2]
+    chat_id = call.message.chat.id
+    batch = await generation_jobs.get_batch(int(value)) if value.isdigit() else None
+    if batch is None or batch[0] != chat_id:
+        await call.message.answer("Пакет не знайдено.")
+        return
+    await call.message.edit_reply_markup()
+    await generation_jobs.set_batch_status(int(value), RUNNING)
+    await start_bulk_batch(chat_id, int(value))
+
+@dp.callback_query(F.data.startswith(JOB_RESEND_CALLBACK))
+async def job_resend_callback(call: types.CallbackQuery):
+    try:
+        await call.answer()
+    except Exception:
+        pass
+    value = call.data.partition(":")[2]
+    chat_id = call.message.chat.id
+    job = await generation_jobs.get(int(value)) if value.isdigit() else None
+    if job is None or job.chat_id != chat_id or job.result is None:
+        await call.message.answer("Результат не знайдено — спробуйте згенерувати допис знову.")
+        return
+    await call.message.edit_reply_markup()
+    asyncio.create_task(generation_guard.run(chat_id, lambda: resend_job(job)))
+
+@dp.callback_query(F.data.startswith((HISTORY_LIST_CALLBACK, HISTORY_SEARCH_CALLBACK, HISTORY_RESEND_CALLBACK)))
+async def history_callback(call: types.CallbackQuery, state: FSMContext):
+    try:
+        await call.answer()
+    except Exception:
+        pass
+    value = call.data.partition(":")[2]
+    if not value.isdigit():
+        return
+    owner_id = call.message.chat.id
+    if call.data.startswith(HISTORY_RESEND_CALLBACK):
+        post = await post_history.get(owner_id, int(value))
+        if post is None:
+            await call.message.answer("Допис не знайдено.")
+            return
+        await send_post(owner_id, post.text)
+    elif call.data.startswith(HISTORY_SEARCH_CALLBACK):
+        query = (await state.get_data()).get("history_query")
+        await show_history_page(call.message, owner_id, int(value), query, edit=True)
+    else:
+        await show_history_page(call.message, owner_id, int(value), edit=True)
+
 @dp.message(Form.in_wizard, F.text)
 async def process_text_answer(message: types.Message, state: FSMContext):
     data = await state.get_data()
     current_step_index = data.get("current_step_index", 0)
-    step = WIZARD_STEPS[current_step_index]
-    if step['type'] == 'text':
-        await state.update_data({step['key']: message.text})
-        await state.update_data({"current_step_index": current_step_index + 1})
-        await ask_question(message, state)
+    step = STEPS[current_step_index]
+    if step.type == 'text':
+        await advance_wizard(message, state, current_step_index, {step.key: message.text})
     else:
         await message.answer("Будь ласка, оберіть один з варіантів за допомогою кнопок.")
 
@@ -231,87 +1063,218 @@ async def process_callback(call: types.CallbackQuery, state: FSMContext):
         data = await state.get_data()
         current_step_index = data.get("current_step_index", 0)
         try:
-            if call.data == "skip_step":
+            if call.data == SKIP_STEP_CALLBACK:
                 await call.message.delete()
-                await state.update_data({"current_step_index": current_step_index + 1})
-                await ask_question(call.message, state)
-            elif call.data.startswith("select:"):
-                parts = call.data.split(':')
-                if len(parts) != 3:
+                await advance_wizard(call.message, state, current_step_index)
+            elif (choice := parse_choice_callback(call.data)) is not None:
+                step, selected_value = choice
+                if step.index != current_step_index:
                     return
-                key, raw_idx = parts[1], parts[2]
 
-                step_index = next(
-                    (idx for idx, s in enumerate(WIZARD_STEPS) if s['key'] == key and s.get('type') == 'choice'),
-                    None
-                )
-                if step_index is None or step_index != current_step_index:
-                    return
-                step = WIZARD_STEPS[step_index]
-
-                try:
-                    option_index = int(raw_idx)
-                    selected_value = step['options'][option_index]
-                except (ValueError, IndexError):
-                    return
-
-                updated_text = f"{step['question']}\n\n*✅ Ваш вибір: {selected_value}*"
-                await call.message.edit_text(updated_text)
-                await state.update_data({key: selected_value})
-                await state.update_data({"current_step_index": step_index + 1})
-                await asyncio.sleep(1)
-                await ask_question(call.message, state)
+                await call.message.edit_text(step.answered_text(selected_value))
+                await advance_wizard(call.message, state, step.index, {step.key: selected_value})
         except Exception:
-            pass
+            logging.exception(f"Помилка обробки кроку майстра ({call.data})")
 
     try:
         if call.data == "confirm_generation":
-            await call.message.edit_reply_markup()
-            await generate_posts(call.message, state)
+            await confirm_generation(call, state)
         elif call.data == "regenerate":
-            await call.message.delete()
-            await generate_posts(call.message, state, is_regenerate=True)
+            await regenerate(call, state)
         elif call.data == "finish_generation":
+            speculation.cancel(call.message.chat.id)
             await state.clear()
             await call.message.edit_text("✅ Дякую за використання бота!")
             await send_main_menu(call.message)
         elif call.data == "cancel_wizard":
+            speculation.cancel(call.message.chat.id)
             await state.clear()
             await call.message.edit_text("❌ Створення допису скасовано.")
             await send_main_menu(call.message)
     except Exception:
-        pass
+        logging.exception(f"Помилка обробки кнопки {call.data}")
 
 # --- Health-check ---
 @app.get("/")
 async def root():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "duplicates_suppressed": update_dedupe.duplicates_suppressed,
+        "generations_joined": generation_guard.joined,
+        "delivery": delivery.stats,
+        "pid": os.getpid(),
+        "leader": leader.is_leader,
+        "startup": startup_timings,
+    }
+
+# --- Метрики ---
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(render_metrics())
 
 # --- Webhook ---
 @app.post(WEBHOOK_PATH)
-async def bot_webhook(update: dict):
+async def bot_webhook(update: dict, x_telegram_bot_api_secret_token: str = Header(None)):
+    if WEBHOOK_SECRET and x_telegram_bot_api_secret_token != WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    with WEBHOOK_SECONDS.time():
+        return await handle_webhook(update)
+
+
+async def handle_webhook(update: dict):
     if "update_id" not in update:  # щоб health-check не заважав
         return {"status": "ignored"}
-    telegram_update = types.Update(**update)
-    await dp.feed_update(bot=bot, update=telegram_update)
+    try:
+        telegram_update = types.Update(**update)
+    except ValidationError as e:
+        logging.warning(f"Некоректний апдейт {update.get('update_id')}: {e}")
+        return {"status": "invalid"}
+
+    if update_dedupe.check_and_add(telegram_update.update_id):
+        return {"status": "duplicate"}
+    # Повторну доставку може прийняти інший воркер — перевіряємо і спільний стан
+    update_key = f"update:{telegram_update.update_id}"
+    if shared_state.cross_process and not await shared_state.add_if_absent(update_key, DEDUPE_WINDOW):
+        update_dedupe.duplicates_suppressed += 1
+        return {"status": "duplicate"}
+    if await is_duplicate_generation_tap(telegram_update):
+        update_dedupe.duplicates_suppressed += 1
+        asyncio.create_task(answer_duplicate_tap(telegram_update.callback_query.as_(bot)))
+        return {"status": "duplicate"}
+
+    if UPDATE_WORKERS <= 0:
+        await process_update(telegram_update)
+        return {"status": "ok"}
+
+    queued = await update_queue.submit(
+        update_chat_key(telegram_update), telegram_update, timeout=UPDATE_QUEUE_PUT_TIMEOUT
+    )
+    if not queued:
+        # Telegram повторить доставку пізніше
+        update_dedupe.discard(telegram_update.update_id)
+        if shared_state.cross_process:
+            await shared_state.discard(update_key)
+        if (tap_key := generation_tap_key(telegram_update)) is not None:
+            await shared_state.discard(tap_key)
+        raise HTTPException(status_code=503, detail="Update queue is full")
     return {"status": "ok"}
 
+job_cleanup_task = None
+leader_task = None
+LLM_WARM_UP_DELAY = 1  # секунди: перший апдейт після старту не чекає на імпорт prompt_logic
+
+
+def webhook_url() -> str:
+    """URL вебхука з відбитком секрету: getWebhookInfo не повертає секрет, тож його зміну видно по URL."""
+    url = BASE_WEBHOOK_URL + WEBHOOK_PATH
+    if WEBHOOK_SECRET:
+        url += "?s=" + hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()[:12]
+    return url
+
+
+async def ensure_webhook(url: str) -> bool:
+    """Реєструє вебхук, лише якщо в Telegram записано інший URL (чи секрет); True — якщо реєстрував."""
+    try:
+        info = await bot.get_webhook_info()
+        if info.url == url:
+            return False
+    except Exception as e:
+        logging.warning(f"Не вдалося отримати getWebhookInfo, реєструю вебхук заново: {e}")
+    await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET)
+    return True
+
+
+async def notify_admin(text: str):
+    try:
+        await bot.send_message(ADMIN_ID, text)
+    except Exception as e:
+        logging.error(f"Не вдалося надіслати повідомлення адміну: {e}")
+
+
+async def lead(first_start: bool):
+    """Обов'язки, які виконує лише один воркер: очищення задач, вебхук, відновлення і повідомлення адміну.
+
+    Виконується у фоні, тож апдейти приймаються, не чекаючи на запити до Bot API.
+    first_start=False — лідерство перейшло від воркера, що впав: задачі інших
+    воркерів уже виконуються, тож відновлення й повідомлення пропускаються.
+    """
+    global job_cleanup_task
+    job_cleanup_task = asyncio.create_task(cleanup_generation_jobs())
+    url = webhook_url()
+    try:
+        registered = await ensure_webhook(url)
+        logging.info(f"Вебхук {'зареєстровано' if registered else 'вже актуальний'}: {BASE_WEBHOOK_URL + WEBHOOK_PATH}")
+    except Exception:
+        logging.exception("Не вдалося зареєструвати вебхук")
+    if not first_start:
+        return
+    try:
+        await resume_generation_jobs()
+        await resume_bulk_batches()
+    except Exception:
+        logging.exception("Не вдалося відновити задачі генерації")
+    if ADMIN_ID:
+        asyncio.create_task(notify_admin(f"✅ Бот перезапущено!\nWebhook: {BASE_WEBHOOK_URL + WEBHOOK_PATH}"))
+
+
+async def wait_for_leadership():
+    while not leader.try_acquire():
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+    logging.info(f"Воркер {os.getpid()} став лідером")
+    try:
+        await lead(first_start=False)
+    except Exception:
+        logging.exception("Не вдалося виконати обов'язки лідера")
+
+
+async def warm_up_llm():
+    """Завантажує prompt_logic і створює HTTP-клієнт LLM після старту, щоб перша генерація на це не чекала."""
+    await asyncio.sleep(LLM_WARM_UP_DELAY)
+    started_at = time.perf_counter()
+    prompt_logic.get_llm_client()
+    startup_timings["llm_warm_up_seconds"] = round(time.perf_counter() - started_at, 4)
+
+
 @app.on_event("startup")
 async def on_startup():
-    webhook_url = BASE_WEBHOOK_URL + WEBHOOK_PATH
-    await bot.delete_webhook()
-    await bot.set_webhook(url=webhook_url)
-    if ADMIN_ID:
-        try:
-            await bot.send_message(ADMIN_ID, f"✅ Бот перезапущено!\nWebhook: {webhook_url}")
-        except Exception as e:
-            logging.error(f"Не вдалося надіслати повідомлення адміну: {e}")
+    started_at = time.perf_counter()
+    update_dedupe.load()
+    if UPDATE_WORKERS > 0:
+        update_queue.start()
+    post_history.start()
+    if WEB_CONCURRENCY > 1 and not FSM_STORAGE_PATH:
+        logging.warning("FSM у пам'яті при кількох воркерах: стан майстра не буде спільним (задайте FSM_STORAGE_PATH)")
+    global leader_task
+    if leader.try_acquire():
+        leader_task = asyncio.create_task(lead(first_start=True))
+    else:
+        leader_task = asyncio.create_task(wait_for_leadership())
+    asyncio.create_task(warm_up_llm())
+    startup_timings["startup_seconds"] = round(time.perf_counter() - started_at, 4)
+    logging.info(f"Старт: імпорт {startup_timings['import_seconds']} с, on_startup {startup_timings['startup_seconds']} с")
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    await bot.delete_webhook()
+    # Вебхук лишається зареєстрованим: апдейти, що прийдуть під час рестарту, Telegram
+    # доставить повторно, а наступний старт не реєструє його заново
+    await update_queue.stop(drain_timeout=UPDATE_DRAIN_TIMEOUT)
+    if leader.is_leader:
+        update_dedupe.save()
+    await dp.storage.close()
+    for task in (job_cleanup_task, leader_task):
+        if task is not None:
+            task.cancel()
+    generation_jobs.close()
+    await post_history.stop()
+    speculation.cancel_all()
+    await prompt_logic.close_llm_client()
+    shared_state.close()
+    leader.release()
+
+# Від початку імпорту main до кінця створення застосунку (бот, диспетчер, хендлери)
+startup_timings["import_seconds"] = round(time.perf_counter() - _import_started_at, 4)
 
 # --- Запуск uvicorn ---
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
+    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False, workers=WEB_CONCURRENCY)
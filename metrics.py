@@ -0,0 +1,194 @@
+import json
+import time
+import random
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Межі гістограм за замовчуванням (секунди)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        REGISTRY.append(self)
+
+    def _label_str(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = super().render()
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{self._label_str(labels)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значення, яке можна встановити напряму або зчитати функцією під час рендеру."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+        self.func = func
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self) -> list:
+        lines = super().render()
+        if self.func is not None:
+            lines.append(f"{self.name} {self.func()}")
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{self._label_str(labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [лічильники по бакетах..., +Inf, сума]
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *labels)
+
+    def render(self) -> list:
+        lines = super().render()
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._label_str(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{self._label_str(labels)} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render_metrics() -> str:
+    """Усі метрики у текстовому форматі Prometheus."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Метрики бота ---
+WEBHOOK_SECONDS = Histogram("bot_webhook_seconds", "Час обробки HTTP-запиту вебхука")
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Повний час обробки апдейту диспетчером")
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Час роботи хендлера", labels=("handler",))
+FSM_FLUSH_SECONDS = Histogram("bot_fsm_flush_seconds", "Час запису змін FSM на диск")
+LLM_ATTEMPT_SECONDS = Histogram("bot_llm_attempt_seconds", "Час однієї спроби запиту до LLM", labels=("attempt", "outcome"))
+LLM_RETRIES = Counter("bot_llm_retries_total", "Повторні спроби запитів до LLM")
+LLM_ERRORS = Counter("bot_llm_errors_total", "Помилки запитів до LLM", labels=("kind",))
+LLM_HEDGES = Counter("bot_llm_hedges_total", "Дублюючі запити до LLM", labels=("result",))
+LLM_CIRCUIT_STATE = Gauge("bot_llm_circuit_state", "Стан запобіжника моделі (0 — closed, 1 — half_open, 2 — open)", labels=("model",))
+LLM_CIRCUIT_REJECTED = Counter("bot_llm_circuit_rejected_total", "Запити, відхилені розімкненим запобіжником", labels=("model",))
+LLM_TOKENS = Counter("bot_llm_tokens_total", "Використані токени (з поля usage)", labels=("type",))
+VARIANTS_PARSED = Counter("bot_variants_parsed_total", "Розпізнані варіанти дописів")
+VARIANT_PARSE_FALLBACKS = Counter("bot_variant_parse_fallbacks_total", "Відповіді, в яких не вдалося розпізнати варіанти")
+PLAIN_TEXT_FALLBACKS = Counter("bot_plain_text_fallbacks_total", "Частини дописів, надіслані простим текстом після помилки розмітки")
+GENERATION_JOBS = Counter("bot_generation_jobs_total", "Події задач генерації", labels=("event",))
+BULK_ROWS = Counter("bot_bulk_rows_total", "Рядки пакетної генерації за результатом", labels=("outcome",))
+GENERATIONS_IN_FLIGHT = Gauge("bot_generations_in_flight", "Генерації, що виконуються зараз")
+SPECULATIONS = Counter("bot_speculations_total", "Спекулятивні генерації за результатом", labels=("kind", "outcome"))
+SPECULATION_TOKENS = Counter("bot_speculation_tokens_total", "Оцінка токенів спекулятивних генерацій", labels=("outcome",))
+
+
+# --- Трасування апдейтів ---
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class UpdateTrace:
+    __slots__ = ("update_id", "started_at", "spans")
+
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.started_at = time.perf_counter()
+        self.spans = []
+
+
+def start_trace(update_id: int, sample_rate: float):
+    """Починає трасування апдейту з імовірністю sample_rate (інакше нічого не робить)."""
+    if sample_rate <= 0 or (sample_rate < 1 and random.random() >= sample_rate):
+        return None, None
+    trace = UpdateTrace(update_id)
+    return trace, _current_trace.set(trace)
+
+
+def finish_trace(trace: UpdateTrace, token, slow_threshold: float):
+    """Логує трасу, якщо апдейт оброблявся довше за slow_threshold секунд."""
+    _current_trace.reset(token)
+    total = time.perf_counter() - trace.started_at
+    if total >= slow_threshold:
+        logging.info("slow update trace: " + json.dumps({
+            "update_id": trace.update_id,
+            "total_ms": round(total * 1000, 1),
+            "spans": trace.spans,
+        }, ensure_ascii=False))
+
+
+@contextmanager
+def span(name: str):
+    """Відрізок траси поточного апдейту; без активної траси майже нічого не коштує."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append({
+            "name": name,
+            "start_ms": round((started_at - trace.started_at) * 1000, 1),
+            "duration_ms": round((time.perf_counter() - started_at) * 1000, 1),
+        })
@@ -0,0 +1,164 @@
+import re
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import NamedTuple
+
+# Поля форми, що зберігаються окремими колонками й індексуються для пошуку
+INDEXED_FIELDS = ("platform", "district", "complexName", "propertyType", "street", "goal")
+WRITE_BATCH_SIZE = 200
+
+_TERM_RE = re.compile(r'\w+')
+
+
+class HistoryPost(NamedTuple):
+    id: int
+    created_at: float
+    form_data: dict
+    text: str
+
+
+def owner_token(owner_id: int) -> str:
+    """Власник як один токен FTS: unicode61 розбив би "u-100123" на "u" і "100123"."""
+    return f"u{'n' if owner_id < 0 else ''}{abs(owner_id)}"
+
+
+def fts_query(owner_id: int, query: str):
+    """FTS5-запит: дописи власника, що містять усі слова запиту (як префікси).
+
+    Власник — окремий токен у колонці owner, тож FTS сам перетинає множини
+    і пошук не сканує чужі дописи. Повертає None, якщо в запиті немає слів.
+    """
+    terms = _TERM_RE.findall(query)
+    if not terms:
+        return None
+    return f'owner:{owner_token(owner_id)} AND ' + " AND ".join(f'"{term}"*' for term in terms[:10])
+
+
+class PostHistory:
+    """Історія згенерованих дописів у SQLite з повнотекстовим індексом FTS5.
+
+    record() лише ставить допис у чергу — запис на диск робить фонова задача
+    пакетами, тож доставка дописів не чекає на SQLite.
+    owner_id — id чату (бот працює в приватних чатах, тож це і є користувач).
+    """
+
+    def __init__(self, path: str, page_size: int = 5):
+        self.path = path
+        self.page_size = page_size
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS posts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, owner_id INTEGER NOT NULL, created_at REAL NOT NULL, "
+            "form_data TEXT NOT NULL, text TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS posts_owner ON posts (owner_id, id)")
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5("
+            f"owner, text, {', '.join(INDEXED_FIELDS)}, "
+            "content='', tokenize='unicode61 remove_diacritics 2')"
+        )
+        self._conn.commit()
+        self._pending = asyncio.Queue()
+        self._writer = None
+
+    # --- Запис ---
+    def record(self, owner_id: int, form_data: dict, posts: list):
+        """Додає дописи в чергу на запис (не блокує)."""
+        now = time.time()
+        for text in posts:
+            self._pending.put_nowait((owner_id, now, form_data, text))
+
+    def _write(self, items):
+        with self._db_lock, self._conn:
+            for owner_id, created_at, form_data, text in items:
+                cursor = self._conn.execute(
+                    "INSERT INTO posts (owner_id, created_at, form_data, text) VALUES (?, ?, ?, ?)",
+                    (owner_id, created_at, json.dumps(form_data, ensure_ascii=False), text),
+                )
+                fields = [str(form_data.get(field) or "") for field in INDEXED_FIELDS]
+                self._conn.execute(
+                    f"INSERT INTO posts_fts (rowid, owner, text, {', '.join(INDEXED_FIELDS)}) "
+                    f"VALUES (?, ?, ?, {', '.join('?' * len(INDEXED_FIELDS))})",
+                    (cursor.lastrowid, owner_token(owner_id), text, *fields),
+                )
+
+    def _take_batch(self) -> list:
+        items = []
+        while not self._pending.empty() and len(items) < WRITE_BATCH_SIZE:
+            items.append(self._pending.get_nowait())
+        return items
+
+    async def _writer_loop(self):
+        while True:
+            items = [await self._pending.get()]
+            items.extend(self._take_batch())
+            try:
+                await asyncio.to_thread(self._write, items)
+            except Exception:
+                logging.exception(f"Не вдалося записати в історію {len(items)} дописів")
+
+    def start(self):
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._writer_loop())
+
+    async def stop(self):
+        """Зупиняє фоновий запис, дописує чергу й закриває базу."""
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        while items := self._take_batch():
+            await asyncio.to_thread(self._write, items)
+        with self._db_lock:
+            self._conn.close()
+
+    # --- Читання ---
+    def _query(self, sql: str, params: tuple) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _posts(rows) -> list:
+        return [HistoryPost(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    async def latest(self, owner_id: int, page: int = 0) -> tuple:
+        """Сторінка останніх дописів: (дописи, чи є наступна сторінка)."""
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, created_at, form_data, text FROM posts WHERE owner_id = ? "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            (owner_id, self.page_size + 1, page * self.page_size),
+        )
+        return self._posts(rows[:self.page_size]), len(rows) > self.page_size
+
+    async def search(self, owner_id: int, query: str, page: int = 0) -> tuple:
+        """Сторінка знайдених дописів (новіші першими): (дописи, чи є наступна сторінка)."""
+        match = fts_query(owner_id, query)
+        if match is None:
+            return [], False
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT p.id, p.created_at, p.form_data, p.text FROM posts_fts "
+            "JOIN posts p ON p.id = posts_fts.rowid WHERE posts_fts MATCH ? "
+            "ORDER BY posts_fts.rowid DESC LIMIT ? OFFSET ?",
+            (match, self.page_size + 1, page * self.page_size),
+        )
+        return self._posts(rows[:self.page_size]), len(rows) > self.page_size
+
+    async def get(self, owner_id: int, post_id: int):
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, created_at, form_data, text FROM posts WHERE id = ? AND owner_id = ?",
+            (post_id, owner_id),
+        )
+        return self._posts(rows)[0] if rows else None
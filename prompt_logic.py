@@ -1,52 +1,69 @@
 import os
+import re
+import json
+import time
+import random
 import httpx # Використовуємо httpx замість requests
 import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
 from textwrap import dedent
+from typing import NamedTuple
+
+from metrics import (
+    LLM_ATTEMPT_SECONDS, LLM_RETRIES, LLM_ERRORS, LLM_TOKENS, LLM_HEDGES, LLM_CIRCUIT_REJECTED, span
+)
+from llm_resilience import LatencyTracker, HedgeBudget, CircuitBreaker, LLMUnavailableError
 
 # --- Конфігурація ---
 GPT_MODEL = "gpt-4.1"
 MAX_TOKENS = 7000
 TEMPERATURE = 0.7
 MAX_RETRIES = 3
-RETRY_DELAY = 5  # секунди
-
-# --- Функція побудови промпту (з невеликими покращеннями) ---
-def build_social_prompt(form_data: dict) -> tuple:
-    """Формує текстовий запит (промпт) для мовної моделі."""
-    
-    # ... (ця функція залишається майже без змін, копіюю її для повноти) ...
-    social_network = form_data.get('platform', 'Instagram')
-    post_type = form_data.get('goal', 'Продемонструвати якість та деталі')
-    variations = form_data.get('variations', '1')
-
-    topic_parts = [f"Допис про {form_data.get('propertyType', 'нерухомість')}"]
-    rooms = form_data.get('rooms')
-    if rooms and rooms != '_пропущено_': topic_parts.append(f"({rooms})" if rooms in ['Студія', '4+'] else f"({rooms} кімнат)")
-    area = form_data.get('area')
-    if area and area != '_пропущено_': topic_parts.append(f"площею {area} м²")
-    district = form_data.get('district')
-    if district and district != '_пропущено_': topic_parts.append(f"в районі {district}")
-    topic = " ".join(topic_parts) + "."
-
-    features = form_data.get('features')
-    street = form_data.get('street')
-    complex_name = form_data.get('complexName')
-    object_status = form_data.get('objectStatus')
-
-    details = []
-    if features and features != '_пропущено_':
-        details.append(f"Ключові особливості: {features}.")
-    if object_status and object_status != '_пропущено_':
-        details.append(f"Статус об'єкта: {object_status}.")
-    if complex_name and complex_name != '_пропущено_':
-        details.append(f"ЖК: {complex_name}.")
-    if street and street != '_пропущено_':
-        details.append(f"Вулиця: {street}.")
-
-    details_text = " ".join(details) if details else ""
-    
-    # --- Повний системний промпт ---
-    system_prompt = dedent("""
+RETRY_BASE_DELAY = 1  # секунди, база експоненційної затримки
+RETRY_MAX_DELAY = 30  # секунди
+
+# --- Ліміти провайдера ---
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "500"))  # 0 — без обмеження
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "200000"))  # 0 — без обмеження
+# Воркери uvicorn (WEB_CONCURRENCY) мають спільні ліміти провайдера — кожен отримує свою частку
+LLM_PROCESSES = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+QUEUE_POSITION_INTERVAL = 3  # секунди між оновленнями позиції в черзі
+
+# --- HTTP-клієнт для LLM ---
+LLM_API_URL = os.getenv("LLM_API_URL", "https://api.openai.com/v1/chat/completions")
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))  # секунди
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "0") == "1"
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))  # секунди
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "90"))  # секунди
+
+# --- Хвостова затримка: загальний бюджет часу, дублюючі запити, запобіжник ---
+LLM_REQUEST_BUDGET = float(os.getenv("LLM_REQUEST_BUDGET", "120"))  # секунди на запит разом з повторами
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL")  # модель, якщо запобіжник основної розімкнено
+LLM_HEDGING = os.getenv("LLM_HEDGING", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))  # дубль після такого перцентиля
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))  # секунди
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))  # частка від усіх запитів
+LLM_HEDGE_PER_MINUTE = int(os.getenv("LLM_HEDGE_PER_MINUTE", "30"))
+LLM_CIRCUIT_FAILURE_RATIO = float(os.getenv("LLM_CIRCUIT_FAILURE_RATIO", "0.5"))
+LLM_CIRCUIT_MIN_REQUESTS = int(os.getenv("LLM_CIRCUIT_MIN_REQUESTS", "10"))
+LLM_CIRCUIT_WINDOW = float(os.getenv("LLM_CIRCUIT_WINDOW", "60"))  # секунди
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))  # секунди
+
+_llm_client = None
+
+# --- Розбір варіантів ---
+VARIANT_PATTERN = r'(## Варіант \d+.*?)(?=\n## Варіант \d+|\Z)'
+VARIANT_HEADER_RE = re.compile(r'^## Варіант \d+', re.M)
+
+# --- Повний системний промпт ---
+# Рендериться один раз при імпорті: незмінний префікс запиту дозволяє провайдеру
+# кешувати промпт між запитами.
+SYSTEM_PROMPT = dedent("""
     Ти — талановитий маркетолог та копірайтер, що спеціалізується на просуванні послуг з ремонту квартир преміум та комфорт-класу в Одесі. Ти вмієш бачити не просто стіни та матеріали, а створювати історію про затишок, стиль та нове життя.
 
     Твоя мета — створювати яскраві, переконливі та емоційні тексти для соціальних мереж (Instagram). Тексти мають демонструвати якість роботи, викликати довіру, підкреслювати експертність та спонукати потенційних клієнтів звернутися за консультацією.
@@ -123,6 +140,118 @@ def build_social_prompt(form_data: dict) -> tuple:
     - Надай кожен варіант допису чітко відокремленим. Почни кожен варіант із заголовка Markdown `## Варіант N`, а потім сам текст допису.
     """).strip()
 
+# --- Бюджет токенів ---
+# Системний промпт вимагає не більше 2200 символів на допис для всіх платформ
+PLATFORM_CHAR_LIMITS = {'Instagram': 2200, 'Facebook': 2200, 'Tik-Tok': 2200}
+DEFAULT_CHAR_LIMIT = 2200
+TOKENS_PER_CHAR = 0.5  # кирилиця: ~2 символи на токен (з запасом)
+TOKENS_PER_ASCII_CHAR = 0.25
+VARIANT_OVERHEAD_TOKENS = 80  # заголовок `## Варіант N`, хештеги, порожні рядки
+MAX_VARIATIONS = 5
+
+
+def estimate_tokens(text: str) -> int:
+    """Офлайн-оцінка кількості токенів без токенізатора (з невеликим запасом)."""
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return int(ascii_chars * TOKENS_PER_ASCII_CHAR + (len(text) - ascii_chars) * TOKENS_PER_CHAR) + 1
+
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+
+
+def parse_variations(value) -> int:
+    try:
+        return min(max(int(value), 1), MAX_VARIATIONS)
+    except (TypeError, ValueError):
+        return 1
+
+
+def compute_max_tokens(variations, platform: str = None) -> int:
+    """max_tokens під кількість варіантів і ліміт символів платформи (не більше MAX_TOKENS)."""
+    char_limit = PLATFORM_CHAR_LIMITS.get(platform, DEFAULT_CHAR_LIMIT)
+    per_variant = int(char_limit * TOKENS_PER_CHAR) + VARIANT_OVERHEAD_TOKENS
+    return min(MAX_TOKENS, parse_variations(variations) * per_variant)
+
+
+class CompiledPrompt(NamedTuple):
+    system_prompt: str
+    user_prompt: str
+    max_tokens: int
+    estimated_tokens: int  # промпт + max_tokens, для бюджету TPM
+
+
+def compile_prompt(form_data: dict) -> CompiledPrompt:
+    """Промпт разом із бюджетом токенів для конкретного запиту."""
+    system_prompt, user_prompt = build_social_prompt(form_data)
+    max_tokens = compute_max_tokens(form_data.get('variations', '1'), form_data.get('platform', 'Instagram'))
+    estimated_tokens = SYSTEM_PROMPT_TOKENS + estimate_tokens(user_prompt) + max_tokens
+    return CompiledPrompt(system_prompt, user_prompt, max_tokens, estimated_tokens)
+
+
+# Підказки для паралельної генерації, щоб окремі запити не давали однакових текстів
+VARIANT_DIVERSITY_HINTS = (
+    "зроби акцент на емоціях і відчутті дому",
+    "зроби акцент на фактах: площа, планування, стан",
+    "зроби акцент на локації та інфраструктурі поруч",
+    "почни із запитання до читача",
+    "напиши коротко й динамічно",
+)
+
+
+def compile_variant_prompts(form_data: dict) -> list:
+    """Окремий промпт на кожен варіант (для паралельної генерації).
+
+    Кожен промпт просить один варіант і містить власну підказку щодо підходу.
+    """
+    count = parse_variations(form_data.get('variations', '1'))
+    system_prompt, user_prompt = build_social_prompt({**form_data, 'variations': '1'})
+    max_tokens = compute_max_tokens(1, form_data.get('platform', 'Instagram'))
+    prompts = []
+    for index in range(count):
+        lines = user_prompt.split("\n")
+        lines.insert(-1, f"- Підхід до тексту: {VARIANT_DIVERSITY_HINTS[index % len(VARIANT_DIVERSITY_HINTS)]}.")
+        variant_prompt = "\n".join(lines)
+        estimated_tokens = SYSTEM_PROMPT_TOKENS + estimate_tokens(variant_prompt) + max_tokens
+        prompts.append(CompiledPrompt(system_prompt, variant_prompt, max_tokens, estimated_tokens))
+    return prompts
+
+
+# --- Функція побудови промпту (з невеликими покращеннями) ---
+def build_social_prompt(form_data: dict) -> tuple:
+    """Формує текстовий запит (промпт) для мовної моделі."""
+    
+    # ... (ця функція залишається майже без змін, копіюю її для повноти) ...
+    social_network = form_data.get('platform', 'Instagram')
+    post_type = form_data.get('goal', 'Продемонструвати якість та деталі')
+    variations = form_data.get('variations', '1')
+
+    topic_parts = [f"Допис про {form_data.get('propertyType', 'нерухомість')}"]
+    rooms = form_data.get('rooms')
+    if rooms and rooms != '_пропущено_': topic_parts.append(f"({rooms})" if rooms in ['Студія', '4+'] else f"({rooms} кімнат)")
+    area = form_data.get('area')
+    if area and area != '_пропущено_': topic_parts.append(f"площею {area} м²")
+    district = form_data.get('district')
+    if district and district != '_пропущено_': topic_parts.append(f"в районі {district}")
+    topic = " ".join(topic_parts) + "."
+
+    features = form_data.get('features')
+    street = form_data.get('street')
+    complex_name = form_data.get('complexName')
+    object_status = form_data.get('objectStatus')
+
+    details = []
+    if features and features != '_пропущено_':
+        details.append(f"Ключові особливості: {features}.")
+    if object_status and object_status != '_пропущено_':
+        details.append(f"Статус об'єкта: {object_status}.")
+    if complex_name and complex_name != '_пропущено_':
+        details.append(f"ЖК: {complex_name}.")
+    if street and street != '_пропущено_':
+        details.append(f"Вулиця: {street}.")
+
+    details_text = " ".join(details) if details else ""
+    
+
     language = "Українська"
 
     user_prompt_parts = [
@@ -143,52 +272,645 @@ def build_social_prompt(form_data: dict) -> tuple:
 
     user_prompt = "\n".join(user_prompt_parts)
 
-    return (system_prompt, user_prompt)
+    return (SYSTEM_PROMPT, user_prompt)
+
+# --- Спільний HTTP-клієнт ---
+def create_llm_client(transport: httpx.AsyncBaseTransport = None) -> httpx.AsyncClient:
+    """Створює довгоживучий клієнт з пулом з'єднань (keep-alive, опційно HTTP/2)."""
+    http2 = LLM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("LLM_HTTP2=1, але пакет h2 не встановлено — використовую HTTP/1.1")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2, transport=transport)
+
+
+def set_llm_client(client: httpx.AsyncClient):
+    """Встановлює клієнт за замовчуванням для call_llm (напр. клієнт з тестовим транспортом)."""
+    global _llm_client
+    _llm_client = client
+
+
+def get_llm_client() -> httpx.AsyncClient:
+    """Повертає спільний клієнт, створюючи його під час першого звернення."""
+    global _llm_client
+    if _llm_client is None or _llm_client.is_closed:
+        _llm_client = create_llm_client()
+    return _llm_client
+
+
+async def close_llm_client():
+    """Закриває спільний клієнт і всі з'єднання пулу (викликається в on_shutdown)."""
+    global _llm_client
+    if _llm_client is not None:
+        await _llm_client.aclose()
+        _llm_client = None
+
+# --- Планувальник запитів до LLM ---
+class TokenBucket:
+    """Відро токенів, що поповнюється з постійною швидкістю rate_per_minute."""
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Скільки секунд чекати, доки в відрі буде amount токенів."""
+        now = time.monotonic()
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill(time.monotonic())
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self):
+        """Обнуляє відро (провайдер повідомив, що ліміт вичерпано)."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0.0)
+
+
+class LLMScheduler:
+    """Глобальний планувальник: ліміт одночасних запитів, RPM/TPM та чесна черга чатів.
+
+    Чати обслуговуються по колу, тож один чат із кількома запитами не блокує інших.
+    """
+
+    def __init__(self, max_concurrency: int, rpm_limit: int = 0, tpm_limit: int = 0):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm_limit) if rpm_limit > 0 else None
+        self.tokens = TokenBucket(tpm_limit) if tpm_limit > 0 else None
+        self.active = 0
+        self.blocked_until = 0.0  # time.monotonic(), до якого нові запити не надсилаються
+        self._queues = {}  # chat_id -> deque майбутніх (future) очікувачів
+        self._ready = deque()  # черга чатів для обходу по колу
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def position(self, chat_id, waiter) -> int:
+        """Приблизна позиція очікувача в черзі (1 — наступний)."""
+        queue = self._queues.get(chat_id)
+        if not queue or waiter not in queue:
+            return 0
+        depth = queue.index(waiter)
+        ahead = sum(min(len(q), depth + 1) for key, q in self._queues.items() if key != chat_id)
+        return ahead + depth + 1
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency and self._ready:
+            chat_id = self._ready.popleft()
+            queue = self._queues[chat_id]
+            waiter = queue.popleft()
+            if queue:
+                self._ready.append(chat_id)
+            else:
+                del self._queues[chat_id]
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _cancel_waiter(self, chat_id, waiter):
+        queue = self._queues.get(chat_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[chat_id]
+                self._ready.remove(chat_id)
+
+    async def _acquire_slot(self, chat_id, on_queue):
+        waiter = asyncio.get_running_loop().create_future()
+        if chat_id not in self._queues:
+            self._queues[chat_id] = deque()
+            self._ready.append(chat_id)
+        self._queues[chat_id].append(waiter)
+        self._dispatch()
+
+        last_position = None
+        try:
+            while not waiter.done():
+                position = self.position(chat_id, waiter)
+                if on_queue and position and position != last_position:
+                    last_position = position
+                    try:
+                        await on_queue(position)
+                    except Exception as e:
+                        print(f"Не вдалося повідомити позицію в черзі: {e}")
+                if waiter.done():
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), QUEUE_POSITION_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                waiter.cancel()
+                self._cancel_waiter(chat_id, waiter)
+            raise
+
+    async def _wait_budget(self, estimated_tokens: int):
+        while True:
+            delay = max(0.0, self.blocked_until - time.monotonic())
+            if self.requests:
+                delay = max(delay, self.requests.wait_time(1))
+            if self.tokens:
+                delay = max(delay, self.tokens.wait_time(estimated_tokens))
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(estimated_tokens)
+
+    @asynccontextmanager
+    async def slot(self, chat_id=None, estimated_tokens: int = 0, on_queue=None):
+        """Чекає на чергу чату, вільний слот і бюджет RPM/TPM."""
+        await self._acquire_slot(chat_id, on_queue)
+        try:
+            await self._wait_budget(estimated_tokens)
+            yield
+        finally:
+            self._release()
+
+    def block_for(self, seconds: float):
+        """Призупиняє всі нові запити (напр. після 429 з Retry-After)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers):
+        """Враховує x-ratelimit-* заголовки провайдера."""
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            try:
+                exhausted = float(remaining) <= 0
+            except ValueError:
+                continue
+            if exhausted:
+                if bucket:
+                    bucket.drain()
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset:
+                    self.block_for(reset)
+
+
+def parse_duration(value) -> float:
+    """Розбирає тривалість у форматі OpenAI (`1s`, `6m0s`, `20ms`) або число секунд."""
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+
+def retry_after_delay(response) -> float:
+    """Затримка з Retry-After / x-ratelimit-reset-* (0, якщо заголовків немає)."""
+    if response is None:
+        return 0.0
+    retry_after = response.headers.get("retry-after-ms")
+    if retry_after:
+        try:
+            return float(retry_after) / 1000
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return max(
+        parse_duration(response.headers.get("x-ratelimit-reset-requests")),
+        parse_duration(response.headers.get("x-ratelimit-reset-tokens")),
+    )
+
+
+def backoff_delay(attempt: int, response=None) -> float:
+    """Затримка перед повтором: Retry-After від провайдера або експонента з джитером."""
+    delay = retry_after_delay(response)
+    if delay > 0:
+        return min(delay, RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def is_retryable(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+llm_scheduler = LLMScheduler(
+    max(1, LLM_MAX_CONCURRENCY // LLM_PROCESSES), LLM_RPM_LIMIT / LLM_PROCESSES, LLM_TPM_LIMIT / LLM_PROCESSES
+)
+llm_latency = LatencyTracker()
+hedge_budget = HedgeBudget(LLM_HEDGE_MAX_RATIO, LLM_HEDGE_PER_MINUTE)
+_circuit_breakers = {}
+
+
+def circuit_breaker(model: str) -> CircuitBreaker:
+    breaker = _circuit_breakers.get(model)
+    if breaker is None:
+        breaker = _circuit_breakers[model] = CircuitBreaker(
+            model, LLM_CIRCUIT_FAILURE_RATIO, LLM_CIRCUIT_MIN_REQUESTS, LLM_CIRCUIT_WINDOW, LLM_CIRCUIT_COOLDOWN
+        )
+    return breaker
+
+
+def route_model() -> str:
+    """Основна модель, резервна (якщо основна недоступна) або LLMUnavailableError."""
+    if circuit_breaker(GPT_MODEL).allow():
+        return GPT_MODEL
+    LLM_CIRCUIT_REJECTED.inc(GPT_MODEL)
+    if LLM_FALLBACK_MODEL:
+        if circuit_breaker(LLM_FALLBACK_MODEL).allow():
+            return LLM_FALLBACK_MODEL
+        LLM_CIRCUIT_REJECTED.inc(LLM_FALLBACK_MODEL)
+    raise LLMUnavailableError("Сервіс генерації тимчасово недоступний, спробуйте за хвилину.")
+
+
+def attempt_timeout(deadline: float) -> httpx.Timeout:
+    """Таймаути спроби, обрізані залишком загального бюджету запиту."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Вичерпано час, відведений на запит до LLM")
+    return httpx.Timeout(min(LLM_READ_TIMEOUT, remaining), connect=min(LLM_CONNECT_TIMEOUT, remaining))
 
 # --- АСИНХРОННА функція виклику LLM ---
-async def call_llm(system_prompt: str, user_prompt: str) -> str:
-    """АСИНХРОННО викликає мовну модель OpenAI з логікою повторних спроб."""
-    
-    api_key = os.getenv("OPENAI_API_KEY") 
-    api_url = "https://api.openai.com/v1/chat/completions"
-
+def _llm_request(system_prompt: str, user_prompt: str, stream: bool = False, max_tokens: int = None, n: int = 1) -> tuple:
+    """Заголовки, тіло запиту та оцінка токенів для планувальника."""
+    api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI_API_KEY не знайдено!")
 
+    max_tokens = max_tokens or MAX_TOKENS
     headers = {"Authorization": f"Bearer {api_key}"}
     payload = {
         "model": GPT_MODEL,
         "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
         "temperature": TEMPERATURE,
-        "max_tokens": MAX_TOKENS
+        "max_tokens": max_tokens
     }
-
+    if n > 1:
+        payload["n"] = n
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+    system_tokens = SYSTEM_PROMPT_TOKENS if system_prompt is SYSTEM_PROMPT else estimate_tokens(system_prompt)
+    estimated_tokens = system_tokens + estimate_tokens(user_prompt) + max_tokens * n
+    return headers, payload, estimated_tokens
+
+
+async def _handle_retry(attempt: int, response=None, deadline: float = None):
+    """Логує невдалу спробу і чекає перед наступною (або повертає False, якщо досить)."""
+    if response is not None and response.status_code == 429:
+        llm_scheduler.block_for(retry_after_delay(response))
+    if attempt >= MAX_RETRIES - 1:
+        return False
+    delay = backoff_delay(attempt, response)
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        return False
+    LLM_RETRIES.inc()
+    await asyncio.sleep(delay)
+    return True
+
+
+def _observe_attempt(attempt: int, started_at: float, outcome: str):
+    if started_at is not None:
+        LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - started_at, str(attempt + 1), outcome)
+
+
+def _record_health(model: str, response=None):
+    """Результат для запобіжника: 5xx і помилки з'єднання — збій, 4xx не враховуються."""
+    if response is None or response.status_code >= 500:
+        circuit_breaker(model).record(False)
+    elif response.status_code < 400:
+        circuit_breaker(model).record(True)
+    else:
+        circuit_breaker(model).release()
+
+
+async def _post_once(client, headers, payload, chat_id, estimated_tokens, on_queue, attempt, deadline, on_start=None):
+    """Один HTTP-запит через планувальник; помилковий статус піднімає HTTPStatusError."""
+    model = payload["model"]
+    started_at = None
+    try:
+        async with llm_scheduler.slot(chat_id, estimated_tokens, on_queue):
+            timeout = attempt_timeout(deadline)
+            if on_start:
+                on_start(time.monotonic())
+            started_at = time.perf_counter()
+            hedge_budget.record_request()
+            with span("llm_request"):
+                response = await client.post(LLM_API_URL, headers=headers, json=payload, timeout=timeout)
+    except asyncio.CancelledError:
+        _observe_attempt(attempt, started_at, "cancelled")
+        circuit_breaker(model).release()
+        raise
+    except httpx.RequestError:
+        _observe_attempt(attempt, started_at, "error")
+        _record_health(model)
+        raise
+    except TimeoutError:
+        circuit_breaker(model).release()
+        raise
+    llm_scheduler.observe_headers(response.headers)
+    _record_health(model, response)
+    if response.is_error:
+        _observe_attempt(attempt, started_at, "error")
+    else:
+        _observe_attempt(attempt, started_at, "ok")
+        llm_latency.observe(time.perf_counter() - started_at)
+    response.raise_for_status()
+    return response
+
+
+async def _post_hedged(client, headers, payload, chat_id, estimated_tokens, on_queue, attempt, deadline):
+    """Запит із дублем: якщо відповіді немає довше за перцентиль LLM_HEDGE_PERCENTILE,
+    надсилається такий самий запит; перемагає перша успішна відповідь, інший запит скасовується.
+    """
+    hedge_delay = llm_latency.percentile(LLM_HEDGE_PERCENTILE) if LLM_HEDGING else None
+    if hedge_delay is None:
+        return await _post_once(client, headers, payload, chat_id, estimated_tokens, on_queue, attempt, deadline)
+    hedge_delay = max(hedge_delay, LLM_HEDGE_MIN_DELAY)
+
+    started = []  # момент, коли основний запит вийшов із черги
+    primary = asyncio.create_task(_post_once(
+        client, headers, payload, chat_id, estimated_tokens, on_queue, attempt, deadline, on_start=started.append
+    ))
+    tasks = [primary]
+    try:
+        # Час у черзі планувальника не рахується — дубль стоятиме в тій самій черзі
+        while True:
+            wait = hedge_delay if not started else started[0] + hedge_delay - time.monotonic()
+            done, _ = await asyncio.wait({primary}, timeout=max(wait, 0))
+            if done:
+                return primary.result()
+            if started and time.monotonic() >= started[0] + hedge_delay:
+                break
+        if not hedge_budget.try_acquire():
+            LLM_HEDGES.inc("denied")
+            return await primary
+
+        LLM_HEDGES.inc("fired")
+        hedge = asyncio.create_task(_post_once(
+            client, headers, payload, chat_id, estimated_tokens, None, attempt, deadline
+        ))
+        tasks.append(hedge)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    LLM_HEDGES.inc("won" if task is hedge else "lost")
+                    return task.result()
+        LLM_HEDGES.inc("failed")
+        return primary.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def _record_usage(usage: dict):
+    if not usage:
+        return
+    LLM_TOKENS.inc("prompt", amount=usage.get("prompt_tokens", 0))
+    LLM_TOKENS.inc("completion", amount=usage.get("completion_tokens", 0))
+
+
+async def call_llm(system_prompt: str, user_prompt: str, client: httpx.AsyncClient = None,
+                   chat_id=None, on_queue=None, max_tokens: int = None) -> str:
+    """АСИНХРОННО викликає мовну модель OpenAI з логікою повторних спроб.
+
+    client — HTTP-клієнт для запиту; за замовчуванням використовується спільний
+    клієнт процесу (у тестах можна передати клієнт з локальним транспортом).
+    Запит проходить через глобальний планувальник: chat_id визначає чергу чату,
+    on_queue(position) викликається, поки запит чекає своєї черги.
+    max_tokens — ліміт відповіді (див. compile_prompt), за замовчуванням MAX_TOKENS.
+    """
+    choices = await call_llm_choices(
+        system_prompt, user_prompt, client=client, chat_id=chat_id, on_queue=on_queue, max_tokens=max_tokens
+    )
+    return choices[0]
+
+
+async def call_llm_choices(system_prompt: str, user_prompt: str, client: httpx.AsyncClient = None,
+                           chat_id=None, on_queue=None, max_tokens: int = None, n: int = 1) -> list:
+    """Як call_llm, але просить у моделі n незалежних відповідей одним запитом (параметр `n`).
+
+    Повертає список текстів усіх отриманих choices.
+    """
+
+    headers, payload, estimated_tokens = _llm_request(system_prompt, user_prompt, max_tokens=max_tokens, n=n)
+    if client is None:
+        client = get_llm_client()
+
+    deadline = time.monotonic() + LLM_REQUEST_BUDGET
     last_error = None
-    async with httpx.AsyncClient(timeout=90.0) as client:
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = await client.post(api_url, headers=headers, json=payload)
-                response.raise_for_status() # Генерує помилку для кодів 4xx/5xx
-
-                json_response = response.json()
-                if json_response.get("choices"):
-                    return json_response["choices"][0]["message"]["content"].strip()
-                else:
-                    raise Exception(f"Відповідь від API не містить 'choices'.")
-            
-            except httpx.HTTPStatusError as e:
-                # Обробка помилок сервера
-                print(f"Помилка API (статус {e.response.status_code}). Спроба {attempt + 1}/{MAX_RETRIES}")
-                last_error = e.response.text
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY * (attempt + 1))
-                else:
-                    raise Exception(f"Не вдалося отримати відповідь після {MAX_RETRIES} спроб. Остання помилка: {last_error}")
-            except httpx.RequestError as e:
-                # Обробка помилок з'єднання/таймаутів
-                print(f"Помилка з'єднання: {e}. Спроба {attempt + 1}/{MAX_RETRIES}")
-                last_error = str(e)
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY)
+    for attempt in range(MAX_RETRIES):
+        try:
+            payload["model"] = route_model()
+            response = await _post_hedged(
+                client, headers, payload, chat_id, estimated_tokens, on_queue, attempt, deadline
+            )
+
+            json_response = response.json()
+            _record_usage(json_response.get("usage"))
+            if json_response.get("choices"):
+                return [choice["message"]["content"].strip() for choice in json_response["choices"]]
+            else:
+                LLM_ERRORS.inc("no_choices")
+                raise Exception(f"Відповідь від API не містить 'choices'.")
+        
+        except httpx.HTTPStatusError as e:
+            # Обробка помилок сервера
+            print(f"Помилка API (статус {e.response.status_code}). Спроба {attempt + 1}/{MAX_RETRIES}")
+            LLM_ERRORS.inc(f"http_{e.response.status_code}")
+            last_error = e.response.text
+            if not is_retryable(e.response.status_code) or not await _handle_retry(attempt, e.response, deadline):
+                break
+        except httpx.RequestError as e:
+            # Обробка помилок з'єднання/таймаутів
+            print(f"Помилка з'єднання: {e}. Спроба {attempt + 1}/{MAX_RETRIES}")
+            LLM_ERRORS.inc("connection")
+            last_error = str(e) or type(e).__name__
+            if not await _handle_retry(attempt, deadline=deadline):
+                break
+        except TimeoutError as e:
+            # Загальний бюджет часу вичерпано, поки запит чекав у черзі
+            LLM_ERRORS.inc("deadline")
+            last_error = str(e)
+            break
     
-    raise Exception(f"Не вдалося отримати відповідь після {MAX_RETRIES} спроб. Остання помилка: {last_error}")
\ No newline at end of file
+    raise Exception(f"Не вдалося отримати відповідь після {MAX_RETRIES} спроб. Остання помилка: {last_error}")
+
+
+# --- Потокова генерація (SSE) ---
+async def stream_llm(system_prompt: str, user_prompt: str, client: httpx.AsyncClient = None,
+                     chat_id=None, on_queue=None, max_tokens: int = None):
+    """АСИНХРОННИЙ генератор фрагментів тексту з потокової відповіді моделі.
+
+    Повторні спроби виконуються лише доти, доки не отримано жодного фрагмента —
+    після цього помилка передається викликачу, щоб не дублювати текст.
+    Бюджет LLM_REQUEST_BUDGET обмежує очікування до початку відповіді (черга, повтори).
+    """
+
+    headers, payload, estimated_tokens = _llm_request(system_prompt, user_prompt, stream=True, max_tokens=max_tokens)
+    if client is None:
+        client = get_llm_client()
+
+    deadline = time.monotonic() + LLM_REQUEST_BUDGET
+    last_error = None
+    for attempt in range(MAX_RETRIES):
+        received = False
+        started_at = None
+        try:
+            model = payload["model"] = route_model()
+            async with llm_scheduler.slot(chat_id, estimated_tokens, on_queue):
+                timeout = attempt_timeout(deadline)
+                started_at = time.perf_counter()
+                async with client.stream("POST", LLM_API_URL, headers=headers, json=payload, timeout=timeout) as response:
+                    llm_scheduler.observe_headers(response.headers)
+                    if response.is_error:
+                        _record_health(model, response)
+                        await response.aread()
+                    response.raise_for_status()
+
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        _record_usage(chunk.get("usage"))
+                        choices = chunk.get("choices") or []
+                        if not choices:
+                            continue
+                        content = (choices[0].get("delta") or {}).get("content")
+                        if content:
+                            received = True
+                            yield content
+                    # Успіх рахується, лише коли потік дочитано: обрив посередині — один збій, а не два результати
+                    _record_health(model, response)
+                    _observe_attempt(attempt, started_at, "ok")
+                    return
+
+        except (asyncio.CancelledError, GeneratorExit):
+            circuit_breaker(model).release()
+            raise
+
+        except httpx.HTTPStatusError as e:
+            print(f"Помилка API (статус {e.response.status_code}). Спроба {attempt + 1}/{MAX_RETRIES}")
+            _observe_attempt(attempt, started_at, "error")
+            LLM_ERRORS.inc(f"http_{e.response.status_code}")
+            last_error = e.response.text
+            if not is_retryable(e.response.status_code) or not await _handle_retry(attempt, e.response, deadline):
+                break
+        except httpx.RequestError as e:
+            _observe_attempt(attempt, started_at, "error")
+            _record_health(model)
+            LLM_ERRORS.inc("connection")
+            if received:
+                raise Exception(f"З'єднання обірвалося під час генерації: {e}")
+            print(f"Помилка з'єднання: {e}. Спроба {attempt + 1}/{MAX_RETRIES}")
+            last_error = str(e) or type(e).__name__
+            if not await _handle_retry(attempt, deadline=deadline):
+                break
+        except TimeoutError as e:
+            circuit_breaker(model).release()
+            LLM_ERRORS.inc("deadline")
+            last_error = str(e)
+            break
+
+    raise Exception(f"Не вдалося отримати відповідь після {MAX_RETRIES} спроб. Остання помилка: {last_error}")
+
+
+def split_variants(text: str) -> list:
+    """Розбиває повну відповідь моделі на варіанти за заголовками `## Варіант N`."""
+    posts = re.findall(VARIANT_PATTERN, text, flags=re.S)
+    return [post.strip() for post in posts if post.strip()]
+
+
+def number_variant(text: str, number: int) -> str:
+    """Текст одного варіанта із заголовком `## Варіант {number}` (замість того, що дала модель)."""
+    body = text.strip()
+    match = VARIANT_HEADER_RE.match(body)
+    if match:
+        rest = body[match.end():]
+        body = rest.split("\n", 1)[1].strip() if "\n" in rest else ""
+    return f"## Варіант {number}\n{body}" if body else ""
+
+
+class VariantStreamParser:
+    """Інкрементальний розбір потоку: віддає варіант, щойно почався наступний."""
+
+    # Запас, щоб знайти заголовок, розрізаний між двома фрагментами
+    _HEADER_MARGIN = 16
+
+    def __init__(self):
+        self.text = ""
+        self._start = None  # позиція заголовка поточного варіанта
+        self._scan = 0
+
+    def feed(self, chunk: str) -> list:
+        """Додає фрагмент і повертає варіанти, які вже точно завершені."""
+        self.text += chunk
+        completed = []
+        while True:
+            match = VARIANT_HEADER_RE.search(self.text, self._scan)
+            if not match:
+                break
+            if self._start is not None:
+                post = self.text[self._start:match.start()].strip()
+                if post:
+                    completed.append(post)
+            self._start = match.start()
+            self._scan = match.end()
+        self._scan = max(self._scan, len(self.text) - self._HEADER_MARGIN)
+        return completed
+
+    def pending(self) -> str:
+        """Текст варіанта, який ще генерується (для попереднього перегляду)."""
+        if self._start is None:
+            return ""
+        return self.text[self._start:]
+
+    def finish(self) -> list:
+        """Завершує потік і повертає останній варіант."""
+        post = self.pending().strip()
+        self._start = None
+        return [post] if post else []
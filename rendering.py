@@ -0,0 +1,141 @@
+import re
+from html import escape
+from typing import NamedTuple
+
+# Ліміт довжини тексту одного повідомлення Telegram
+TELEGRAM_TEXT_LIMIT = 4096
+
+_PARAGRAPH_SPLIT_RE = re.compile(r'\n[ \t]*\n')
+_HEADER_RE = re.compile(r'^#{1,6}[ \t]+(.+?)[ \t#]*$')
+_BULLET_RE = re.compile(r'^([ \t]*)[-*+][ \t]+')
+_INLINE_RE = re.compile(
+    r'`([^`\n]+)`'
+    r'|\*\*(?=\S)(.+?)(?<=\S)\*\*'
+    r'|__(?=\S)(.+?)(?<=\S)__'
+    r'|(?<![\w*])\*(?=[^\s*])([^*\n]+?)(?<=\S)\*(?![\w*])'
+    r'|(?<![\w_])_(?=[^\s_])([^_\n]+?)(?<=\S)_(?![\w_])'
+    r'|~~(?=\S)(.+?)(?<=\S)~~'
+    r'|\[([^\]\n]+)\]\((https?://[^)\s]+)\)'
+)
+
+
+class RenderedChunk(NamedTuple):
+    html: str  # для parse_mode="HTML"
+    plain: str  # вихідний текст частини — на випадок, якщо Telegram не прийме HTML
+
+
+def _render_inline(text: str) -> str:
+    parts = []
+    position = 0
+    for match in _INLINE_RE.finditer(text):
+        parts.append(escape(text[position:match.start()], quote=False))
+        code, bold, bold_alt, italic, italic_alt, strike, link_text, url = match.groups()
+        if code is not None:
+            parts.append(f"<code>{escape(code, quote=False)}</code>")
+        elif bold is not None or bold_alt is not None:
+            parts.append(f"<b>{_render_inline(bold if bold is not None else bold_alt)}</b>")
+        elif italic is not None or italic_alt is not None:
+            parts.append(f"<i>{_render_inline(italic if italic is not None else italic_alt)}</i>")
+        elif strike is not None:
+            parts.append(f"<s>{_render_inline(strike)}</s>")
+        else:
+            parts.append(f'<a href="{escape(url)}">{_render_inline(link_text)}</a>')
+        position = match.end()
+    parts.append(escape(text[position:], quote=False))
+    return "".join(parts)
+
+
+def _render_line(line: str) -> str:
+    header = _HEADER_RE.match(line)
+    if header:
+        return f"<b>{_render_inline(header.group(1))}</b>"
+    bullet = _BULLET_RE.match(line)
+    if bullet:
+        return f"{bullet.group(1)}• {_render_inline(line[bullet.end():])}"
+    return _render_inline(line)
+
+
+def markdown_to_html(text: str) -> str:
+    """Markdown моделі -> HTML для Telegram.
+
+    Розмітка розбирається в межах рядка, тож незакриті `*`, `_` чи `` ` ``
+    просто лишаються звичайними символами і не ламають повідомлення.
+    """
+    return "\n".join(_render_line(line) for line in text.split("\n"))
+
+
+def _pieces(text: str, separator: str, limit: int, joiner: str = "\n\n"):
+    """Розбиває text за separator; абзаци, що не вміщаються в limit, — ще й по рядках.
+
+    Повертає пари (роздільник перед шматком, шматок). Окремий рядок може
+    лишитися довшим за limit — його ріже вже render_post.
+    """
+    for index, piece in enumerate(text.split(separator)):
+        piece_joiner = joiner if index == 0 else separator
+        if separator == "\n\n" and len(markdown_to_html(piece)) > limit:
+            yield from _pieces(piece, "\n", limit, piece_joiner)
+        else:
+            yield piece_joiner, piece
+
+
+def _cut(piece: str, room: int, hard: bool) -> int:
+    """Довжина початку piece, що після рендерингу вміщається в room символів.
+
+    Ріже за пробілом; якщо пробілу немає, то за символом (hard) або ніде (0).
+    """
+    low, high = 0, min(len(piece), room)
+    while low < high:  # найдовший префікс, HTML якого не довший за room
+        middle = (low + high + 1) // 2
+        if len(markdown_to_html(piece[:middle])) <= room:
+            low = middle
+        else:
+            high = middle - 1
+    cut = piece.rfind(" ", 0, low)
+    while cut > 0 and len(markdown_to_html(piece[:cut])) > room:
+        cut = piece.rfind(" ", 0, cut)
+    if cut > 0:
+        return cut
+    return max(low, 1) if hard else 0
+
+
+def render_post(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list:
+    """Готує допис до надсилання: HTML-розмітка і поділ на повідомлення до limit символів.
+
+    Допис ділиться по абзацах (за потреби — по рядках), тож розмітка ніколи
+    не розривається між двома повідомленнями. Рядок, довший за повідомлення,
+    дописується в поточне повідомлення до заповнення і ріжеться за словом.
+    Чиста функція без I/O.
+    """
+    text = _PARAGRAPH_SPLIT_RE.sub("\n\n", text.strip())
+    chunks = []
+    html_text = plain_text = ""
+    for joiner, piece in _pieces(text, "\n\n", limit):
+        html_piece = markdown_to_html(piece)
+        if plain_text and len(html_text) + len(joiner) + len(html_piece) > limit:
+            if len(html_piece) <= limit:
+                # Шматок вміщається в окреме повідомлення — не розриваємо його
+                chunks.append(RenderedChunk(html_text.strip(), plain_text.strip()))
+                html_text = plain_text = ""
+            else:
+                # Задовгий рядок однаково доведеться різати — спершу заповнюємо поточне
+                cut = _cut(piece, limit - len(html_text) - len(joiner), hard=False)
+                if cut:
+                    html_text += joiner + markdown_to_html(piece[:cut])
+                    plain_text += joiner + piece[:cut]
+                    piece = piece[cut:]
+                chunks.append(RenderedChunk(html_text.strip(), plain_text.strip()))
+                html_text = plain_text = ""
+                html_piece = markdown_to_html(piece)
+        while len(html_piece) > limit:
+            cut = _cut(piece, limit, hard=True)
+            chunks.append(RenderedChunk(markdown_to_html(piece[:cut]).strip(), piece[:cut].strip()))
+            piece = piece[cut:]
+            html_piece = markdown_to_html(piece)
+        if plain_text:
+            html_text += joiner + html_piece
+            plain_text += joiner + piece
+        else:
+            html_text, plain_text = html_piece, piece
+    if plain_text:
+        chunks.append(RenderedChunk(html_text.strip(), plain_text.strip()))
+    return [chunk for chunk in chunks if chunk.plain.strip()]
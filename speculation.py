@@ -0,0 +1,164 @@
+import time
+import asyncio
+import logging
+import contextlib
+from collections import deque
+
+from metrics import SPECULATIONS, SPECULATION_TOKENS
+
+
+class StreamBuffer:
+    """Потік, що читається у фоні: його можна підхопити будь-коли й отримати все з початку, а далі — наживо."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    async def fill(self, stream) -> str:
+        """Дочитує stream у буфер; повертає весь текст."""
+        try:
+            async with contextlib.aclosing(stream):
+                async for chunk in stream:
+                    self.chunks.append(chunk)
+                    self._changed.set()
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            self.done = True
+            self._changed.set()
+        return "".join(self.chunks)
+
+    async def replay(self):
+        """Асинхронний генератор: уже прочитані фрагменти, потім нові, доки потік не закінчиться."""
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                position += 1
+                yield self.chunks[position - 1]
+            if self.done:
+                if self.error is not None:
+                    raise self.error if isinstance(self.error, Exception) else Exception("Генерацію скасовано")
+                return
+            self._changed.clear()
+            await self._changed.wait()
+
+
+class Speculation:
+    __slots__ = ("kind", "key", "task", "estimated_tokens", "timer", "stream")
+
+    def __init__(self, kind, key, task, estimated_tokens, timer, stream=None):
+        self.kind = kind
+        self.key = key
+        self.task = task
+        self.estimated_tokens = estimated_tokens
+        self.timer = timer
+        self.stream = stream  # StreamBuffer потокової спекуляції або None
+
+
+class SpeculativeGenerations:
+    """Фонові генерації, запущені до того, як користувач їх попросив.
+
+    Для кожного чату зберігається щонайбільше одна спекуляція з ключем промпту.
+    take() віддає її, якщо ключ збігся (влучання), інакше скасовує (промах).
+    Невикористані спекуляції скасовуються через ttl секунд.
+
+    Витрати обмежені:
+    - max_in_flight — скільки спекулятивних запитів може йти одночасно;
+    - tokens_per_hour — загальний бюджет оцінених токенів за годину;
+    - chat_per_hour — скільки спекуляцій може запустити один чат за годину.
+    """
+
+    def __init__(self, max_in_flight: int = 4, tokens_per_hour: int = 100000,
+                 chat_per_hour: int = 6, ttl: float = 600):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_hour = tokens_per_hour
+        self.chat_per_hour = chat_per_hour
+        self.ttl = ttl
+        self._speculations = {}  # chat_id -> Speculation
+        self._spent = deque()  # (час, токени) за останню годину
+        self._spent_tokens = 0
+        self._chat_starts = {}  # chat_id -> deque часів запуску
+
+    @property
+    def in_flight(self) -> int:
+        return sum(1 for speculation in self._speculations.values() if not speculation.task.done())
+
+    def _within_budget(self, chat_id, estimated_tokens: int, now: float) -> bool:
+        while self._spent and now - self._spent[0][0] > 3600:
+            self._spent_tokens -= self._spent.popleft()[1]
+        starts = self._chat_starts.get(chat_id)
+        while starts and now - starts[0] > 3600:
+            starts.popleft()
+        if starts is not None and not starts:
+            del self._chat_starts[chat_id]
+            starts = None
+        return (
+            self.in_flight < self.max_in_flight
+            and self._spent_tokens + estimated_tokens <= self.tokens_per_hour
+            and (starts is None or len(starts) < self.chat_per_hour)
+        )
+
+    def start(self, chat_id, key, estimated_tokens: int, factory, kind: str = "summary", stream=None) -> bool:
+        """Запускає factory() у фоні, якщо дозволяють ліміти; попередня спекуляція чату скасовується.
+
+        stream — StreamBuffer, який наповнює factory, щоб результат можна було підхопити ще до кінця генерації.
+        """
+        self.cancel(chat_id, "replaced")
+        now = time.monotonic()
+        if not self._within_budget(chat_id, estimated_tokens, now):
+            SPECULATIONS.inc(kind, "rejected")
+            return False
+
+        self._spent.append((now, estimated_tokens))
+        self._spent_tokens += estimated_tokens
+        self._chat_starts.setdefault(chat_id, deque()).append(now)
+
+        task = asyncio.create_task(factory())
+        timer = asyncio.get_running_loop().call_later(self.ttl, self.cancel, chat_id, "expired")
+        speculation = Speculation(kind, key, task, estimated_tokens, timer, stream)
+        self._speculations[chat_id] = speculation
+        task.add_done_callback(lambda t: self._on_done(speculation))
+        SPECULATIONS.inc(kind, "started")
+        return True
+
+    def _on_done(self, speculation: Speculation):
+        task = speculation.task
+        if task.cancelled() or task.exception() is None:
+            return
+        SPECULATIONS.inc(speculation.kind, "failed")
+        logging.info(f"Спекулятивна генерація завершилася помилкою: {task.exception()}")
+
+    def take(self, chat_id, key):
+        """Повертає спекуляцію з тим самим ключем (її task і stream) або None."""
+        speculation = self._speculations.pop(chat_id, None)
+        if speculation is None:
+            return None
+        speculation.timer.cancel()
+        task = speculation.task
+        if speculation.key != key:
+            self._discard(speculation, "miss")
+            return None
+        if task.done() and task.exception() is not None:
+            return None
+        SPECULATIONS.inc(speculation.kind, "hit")
+        SPECULATION_TOKENS.inc("used", amount=speculation.estimated_tokens)
+        return speculation
+
+    def cancel(self, chat_id, reason: str = "cancelled"):
+        speculation = self._speculations.pop(chat_id, None)
+        if speculation is not None:
+            speculation.timer.cancel()
+            self._discard(speculation, reason)
+
+    def cancel_all(self):
+        for chat_id in list(self._speculations):
+            self.cancel(chat_id)
+
+    @staticmethod
+    def _discard(speculation: Speculation, reason: str):
+        speculation.task.cancel()
+        SPECULATIONS.inc(speculation.kind, reason)
+        SPECULATION_TOKENS.inc("wasted", amount=speculation.estimated_tokens)
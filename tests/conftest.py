@@ -0,0 +1,8 @@
+import os
+
+# main.py читає налаштування під час імпорту: у тестах — лише пам'ять, без файлів у робочій теці
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+for _name in ("JOB_STORE_PATH", "POST_HISTORY_PATH", "FSM_STORAGE_PATH"):
+    os.environ[_name] = ""
+os.environ["SHARED_STATE_URL"] = "memory"
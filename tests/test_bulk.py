@@ -0,0 +1,52 @@
+import io
+
+import pytest
+
+from bulk import BulkFileError, read_table, validate_records
+
+HEADER = ["Платформа", "objectStatus", "Тип нерухомості", "rooms", "Мета тексту", "variations", "district", "Зайва колонка"]
+ROW = ["instagram", "Об'єкт зданий", "Квартира", 2, "Показати експертність", 1, "Печерський", "ігнорується"]
+
+
+def make_xlsx(rows) -> bytes:
+    openpyxl = pytest.importorskip("openpyxl")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def test_xlsx_rows_are_read_and_validated():
+    content = make_xlsx([HEADER, ROW, [None] * len(HEADER), ["Twitter", *ROW[1:]]])
+    records = read_table("objects.XLSX", content)
+    assert len(records) == 2  # порожній рядок пропущено
+    assert records[0]["rooms"] == "2"
+    assert "Зайва колонка" not in records[0]
+
+    rows, errors = validate_records(records)
+    assert rows == [(2, {
+        "platform": "Instagram", "objectStatus": "Об'єкт зданий", "propertyType": "Квартира", "rooms": "2",
+        "goal": "Показати експертність", "variations": "1", "district": "Печерський",
+    })]
+    assert len(errors) == 1 and errors[0].startswith("Рядок 3: platform")
+
+
+def test_csv_with_semicolons_and_cp1251():
+    text = "platform;objectStatus;propertyType;rooms;goal;variations\nFacebook;Робота в процесі;Будинок;4+;Показати експертність;3\n"
+    records = read_table("objects.csv", text.encode("cp1251"))
+    rows, errors = validate_records(records)
+    assert not errors and rows[0][1]["propertyType"] == "Будинок"
+
+
+def test_broken_xlsx_is_reported():
+    pytest.importorskip("openpyxl")
+    with pytest.raises(BulkFileError):
+        read_table("objects.xlsx", b"not a workbook")
+
+
+def test_unknown_columns_are_reported():
+    with pytest.raises(BulkFileError):
+        read_table("objects.csv", "a,b\n1,2\n".encode())
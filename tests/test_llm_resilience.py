@@ -0,0 +1,161 @@
+import json
+import time
+import asyncio
+
+import httpx
+import pytest
+
+import llm_resilience
+import prompt_logic
+from bench.stub_llm import StubConfig, create_app
+from llm_resilience import CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def fresh_llm_state(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(prompt_logic, "llm_scheduler", prompt_logic.LLMScheduler(4))
+    monkeypatch.setattr(prompt_logic, "_circuit_breakers", {})
+    monkeypatch.setattr(prompt_logic, "RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(prompt_logic, "LLM_HEDGING", False)
+
+
+def stub_client(config: StubConfig):
+    app = create_app(config)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://stub")
+    return app, client
+
+
+def test_429_retry_after_pauses_scheduler(monkeypatch):
+    monkeypatch.setattr(prompt_logic, "LLM_API_URL", "http://stub/v1/chat/completions")
+    app, client = stub_client(StubConfig(latency=0, rpm=1, window=1, chunk_delay=0))
+
+    async def scenario():
+        started = time.monotonic()
+        first, second = await asyncio.gather(
+            prompt_logic.call_llm("s", "Кількість варіантів для генерації: 1", client=client, chat_id=1),
+            prompt_logic.call_llm("s", "Кількість варіантів для генерації: 1", client=client, chat_id=2),
+        )
+        return first, second, time.monotonic() - started
+
+    first, second, elapsed = asyncio.run(scenario())
+    assert first.startswith("## Варіант 1") and second.startswith("## Варіант 1")
+    assert app.state.stats["rate_limited"] == 1
+    assert app.state.stats["requests"] == 3
+    assert elapsed >= 1  # Retry-After: 1 від заглушки
+    # 429 — не збій доступності
+    assert prompt_logic.circuit_breaker(prompt_logic.GPT_MODEL).state == CircuitBreaker.CLOSED
+
+
+def test_retry_after_blocks_other_chats():
+    scheduler = prompt_logic.LLMScheduler(4)
+    response = httpx.Response(429, headers={"retry-after": "0.2"})
+    scheduler.block_for(prompt_logic.retry_after_delay(response))
+
+    async def scenario():
+        started = time.monotonic()
+        async with scheduler.slot(chat_id=99):
+            return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.19
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_half_opens_and_closes(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_resilience.time, "monotonic", clock)
+    breaker = CircuitBreaker("m", failure_ratio=0.5, min_requests=4, window=60, cooldown=30)
+
+    for success in (True, False, False, True):
+        assert breaker.allow()
+        breaker.record(success)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now += 31
+    assert breaker.allow()  # пробний запит
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # другий — поки проба не завершилася
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_failed_probe_reopens(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_resilience.time, "monotonic", clock)
+    breaker = CircuitBreaker("m", failure_ratio=0.5, min_requests=2, window=60, cooldown=30)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now += 31
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 10
+    assert not breaker.allow()
+
+    clock.now += 21
+    assert breaker.allow()
+    breaker.release()  # пробу скасовано без результату — можна нову
+    assert breaker.allow()
+
+
+def test_server_errors_open_breaker_and_route_to_fallback(monkeypatch):
+    monkeypatch.setattr(prompt_logic, "LLM_API_URL", "http://stub/v1/chat/completions")
+    monkeypatch.setattr(prompt_logic, "LLM_CIRCUIT_MIN_REQUESTS", 3)
+    monkeypatch.setattr(prompt_logic, "LLM_FALLBACK_MODEL", "fallback-model")
+    app, client = stub_client(StubConfig(latency=0, error_rate=1.0))
+
+    with pytest.raises(Exception):
+        asyncio.run(prompt_logic.call_llm("s", "u", client=client))
+    assert prompt_logic.circuit_breaker(prompt_logic.GPT_MODEL).state == CircuitBreaker.OPEN
+    assert prompt_logic.route_model() == "fallback-model"
+
+
+class DroppingStream(httpx.AsyncByteStream):
+    """SSE, що обривається після першого варіанта."""
+
+    async def __aiter__(self):
+        chunk = {"choices": [{"delta": {"content": "## Варіант 1\nтекст\n\n"}}]}
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+        raise httpx.ReadError("connection reset")
+
+
+def test_stream_drop_counts_as_one_failure():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, stream=DroppingStream()))
+    client = httpx.AsyncClient(transport=transport)
+
+    async def consume():
+        received = []
+        with pytest.raises(Exception, match="обірвалося"):
+            async for chunk in prompt_logic.stream_llm("s", "u", client=client):
+                received.append(chunk)
+        return received
+
+    assert asyncio.run(consume()) == ["## Варіант 1\nтекст\n\n"]
+    breaker = prompt_logic.circuit_breaker(prompt_logic.GPT_MODEL)
+    assert [success for _, success in breaker._results] == [False]
+
+
+def test_completed_stream_counts_as_one_success():
+    def handler(request):
+        chunk = {"choices": [{"delta": {"content": "## Варіант 1\nтекст"}}]}
+        return httpx.Response(200, content=f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode())
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def consume():
+        return [chunk async for chunk in prompt_logic.stream_llm("s", "u", client=client)]
+
+    assert asyncio.run(consume()) == ["## Варіант 1\nтекст"]
+    breaker = prompt_logic.circuit_breaker(prompt_logic.GPT_MODEL)
+    assert [success for _, success in breaker._results] == [True]
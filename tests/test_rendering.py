@@ -0,0 +1,107 @@
+import re
+
+import pytest
+
+from rendering import TELEGRAM_TEXT_LIMIT, markdown_to_html, render_post
+
+_TAG_RE = re.compile(r'<(/?)(\w+)[^>]*>')
+
+
+def assert_balanced(html: str):
+    """Кожен тег частини відкривається й закривається в ній самій."""
+    stack = []
+    for match in _TAG_RE.finditer(html):
+        closing, name = match.groups()
+        if closing:
+            assert stack and stack.pop() == name, html
+        else:
+            stack.append(name)
+    assert not stack, html
+
+
+@pytest.mark.parametrize("text", [
+    "2*3 = 6",
+    "ціна *від власника",
+    "snake_case_name",
+    "_початок без кінця",
+    "ось ` один бектик",
+    "**жирний без кінця",
+])
+def test_unbalanced_markers_stay_literal(text):
+    assert markdown_to_html(text) == text
+
+
+def test_balanced_markup():
+    assert markdown_to_html("**Ціна** _торг_ `код` ~~стара~~") == (
+        "<b>Ціна</b> <i>торг</i> <code>код</code> <s>стара</s>"
+    )
+    assert markdown_to_html("## Варіант 1") == "<b>Варіант 1</b>"
+    assert markdown_to_html("- пункт") == "• пункт"
+
+
+def test_html_special_characters_are_escaped():
+    assert markdown_to_html("3 < 5 > 1 & <b>не тег</b>") == "3 &lt; 5 &gt; 1 &amp; &lt;b&gt;не тег&lt;/b&gt;"
+    assert markdown_to_html("`a<b>&c`") == "<code>a&lt;b&gt;&amp;c</code>"
+
+
+def test_link_href_is_escaped():
+    html = markdown_to_html('[Дивитись](https://example.com/?a=1&b="2")')
+    assert html == '<a href="https://example.com/?a=1&amp;b=&quot;2&quot;">Дивитись</a>'
+
+
+def test_only_http_links_are_rendered():
+    assert markdown_to_html("[клік](javascript:alert(1))") == "[клік](javascript:alert(1))"
+
+
+@pytest.mark.parametrize("text", [
+    "## Варіант 1\n\n" + "слово " * 1200,
+    "\n\n".join(f"**Абзац {i}** " + "текст & <знаки> " * 40 for i in range(60)),
+    ("- пункт з _курсивом_ і [посиланням](https://example.com/?a=1&b=2)\n" * 400),
+    "x" * 9000,
+    "a&b " * 3000,
+])
+def test_chunks_fit_limit_and_keep_tags_whole(text):
+    chunks = render_post(text)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert 0 < len(chunk.html) <= TELEGRAM_TEXT_LIMIT
+        assert_balanced(chunk.html)
+
+
+def test_chunks_keep_all_words():
+    text = "\n\n".join(f"Абзац {i}: " + "слово " * 150 for i in range(40))
+    chunks = render_post(text)
+    assert " ".join(chunk.plain for chunk in chunks).split() == text.split()
+
+
+def test_header_is_packed_with_long_paragraph():
+    chunks = render_post("## Варіант 1\n\n" + "слово " * 1200)
+    assert len(chunks) == 2
+    assert chunks[0].html.startswith("<b>Варіант 1</b>\n\n")
+    assert len(chunks[0].html) > TELEGRAM_TEXT_LIMIT - 10
+
+
+def test_short_paragraph_is_not_split():
+    paragraph = "абзац " * 100
+    chunks = render_post("\n\n".join([paragraph] * 10))
+    for chunk in chunks:
+        assert chunk.plain.count("абзац") % 100 == 0
+
+
+def test_plain_fallback_is_source_text():
+    text = "## Варіант 1\n\n**Ціна:** 100 000 $ & торг\n- [Карта](https://example.com)"
+    (chunk,) = render_post(text)
+    assert chunk.plain == text
+    assert chunk.html == (
+        '<b>Варіант 1</b>\n\n<b>Ціна:</b> 100 000 $ &amp; торг\n• <a href="https://example.com">Карта</a>'
+    )
+
+
+def test_plain_fallback_matches_each_chunk():
+    text = "\n\n".join(f"**Абзац {i}** " + "текст " * 200 for i in range(20))
+    for chunk in render_post(text):
+        assert chunk.html == markdown_to_html(chunk.plain)
+
+
+def test_empty_post():
+    assert render_post("   \n\n  ") == []
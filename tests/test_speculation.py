@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from speculation import SpeculativeGenerations, StreamBuffer
+
+
+async def slow_stream(chunks, delay=0.05, error=None):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+    if error is not None:
+        raise error
+
+
+def test_replay_joins_running_stream_from_the_start():
+    async def scenario():
+        buffer = StreamBuffer()
+        task = asyncio.create_task(buffer.fill(slow_stream(["a", "b", "c", "d"])))
+        await asyncio.sleep(0.12)  # два фрагменти вже прочитано
+        replayed = [chunk async for chunk in buffer.replay()]
+        return replayed, await task
+
+    assert asyncio.run(scenario()) == (["a", "b", "c", "d"], "abcd")
+
+
+def test_replay_raises_stream_error():
+    async def scenario():
+        buffer = StreamBuffer()
+        task = asyncio.create_task(buffer.fill(slow_stream(["a"], error=ValueError("обрив"))))
+        received = []
+        with pytest.raises(ValueError):
+            async for chunk in buffer.replay():
+                received.append(chunk)
+        with pytest.raises(ValueError):
+            await task
+        return received
+
+    assert asyncio.run(scenario()) == ["a"]
+
+
+def test_take_returns_stream_and_miss_cancels():
+    async def scenario():
+        speculations = SpeculativeGenerations()
+        buffer = StreamBuffer()
+        speculations.start(1, "prompt", 100, lambda: buffer.fill(slow_stream(["x"] * 100)), stream=buffer)
+        taken = speculations.take(1, "prompt")
+        assert taken.stream is buffer and not taken.task.done()
+        taken.task.cancel()
+
+        speculations.start(2, "old", 100, lambda: asyncio.sleep(10))
+        task = speculations._speculations[2].task
+        assert speculations.take(2, "new") is None
+        await asyncio.sleep(0)
+        return task.cancelled()
+
+    assert asyncio.run(scenario())
+
+
+def test_confirm_during_speculation_streams_first_post_early(monkeypatch):
+    sent_at = []
+
+    def fake_stream_llm(*args, **kwargs):
+        # Перший варіант готовий швидко, решта генерується ще довго
+        return slow_stream(["## Варіант 1\nперший\n\n## Варіант 2\n", "другий", " текст"], delay=0.2)
+
+    async def send_post(chat_id, post):
+        sent_at.append((asyncio.get_running_loop().time(), post))
+
+    class Placeholder:
+        async def edit_text(self, *args, **kwargs):
+            pass
+
+        async def delete(self):
+            pass
+
+    monkeypatch.setattr(main, "LLM_STREAMING", True)
+    monkeypatch.setattr(main.prompt_logic, "stream_llm", fake_stream_llm)
+    monkeypatch.setattr(main, "send_post", send_post)
+    monkeypatch.setattr(main, "speculation", SpeculativeGenerations())
+    prompt = SimpleNamespace(system_prompt="s", user_prompt="u", max_tokens=100, estimated_tokens=100)
+    message = SimpleNamespace(chat=SimpleNamespace(id=5))
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        main.start_speculation(5, prompt, "summary")
+        await asyncio.sleep(0.3)  # користувач підтверджує посеред генерації
+        speculative = await main.take_speculative_result(5, prompt)
+        assert isinstance(speculative, StreamBuffer)
+        posts, text = await main.stream_posts(message, Placeholder(), prompt, chunks=speculative.replay())
+        return started, posts, text
+
+    started, posts, text = asyncio.run(scenario())
+    assert posts == ["## Варіант 1\nперший", "## Варіант 2\nдругий текст"]
+    assert text == "## Варіант 1\nперший\n\n## Варіант 2\nдругий текст"
+    # Перший допис надіслано одразу після підтвердження, не чекаючи кінця генерації (~0.6 с)
+    assert sent_at[0][0] - started < 0.45
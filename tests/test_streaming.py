@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+MESSAGE = SimpleNamespace(chat=SimpleNamespace(id=1))
+PROMPT = SimpleNamespace(system_prompt="s", user_prompt="u", max_tokens=100)
+
+
+class FakePlaceholder:
+    async def edit_text(self, *args, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+def fake_stream(monkeypatch, chunks, error=None) -> list:
+    """Підміняє потік моделі й надсилання; повертає список надісланих дописів."""
+    sent = []
+
+    async def fake_stream_llm(*args, **kwargs):
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(0)
+        if error is not None:
+            raise error
+
+    async def paced_send_post(chat_id, post):
+        await asyncio.sleep(0.05)  # як DeliveryMiddleware: надсилання повільніше за потік
+        sent.append(post)
+
+    monkeypatch.setattr(main.prompt_logic, "stream_llm", fake_stream_llm)
+    monkeypatch.setattr(main, "send_post", paced_send_post)
+    return sent
+
+
+def stream_posts():
+    return asyncio.run(main.stream_posts(MESSAGE, FakePlaceholder(), PROMPT))
+
+
+def test_all_variants_are_delivered_in_order(monkeypatch):
+    sent = fake_stream(
+        monkeypatch, ["## Варіант 1\nперший — ", "текст\n\n## Варіант 2\nдругий\n\n", "## Варіант 3\nтретій"]
+    )
+    posts, text = stream_posts()
+    assert sent == posts == ["## Варіант 1\nперший - текст", "## Варіант 2\nдругий", "## Варіант 3\nтретій"]
+    assert "—" not in text
+
+
+def test_finished_variants_are_delivered_when_stream_breaks(monkeypatch):
+    sent = fake_stream(
+        monkeypatch,
+        ["## Варіант 1\nперший\n\n## Варіант 2\nдругий\n\n", "## Варіант 3\nнедо"],
+        Exception("З'єднання обірвалося під час генерації"),
+    )
+    with pytest.raises(Exception, match="обірвалося"):
+        stream_posts()
+    # Готові варіанти дочекалися надсилання, недописаний третій — ні
+    assert sent == ["## Варіант 1\nперший", "## Варіант 2\nдругий"]
@@ -0,0 +1,67 @@
+import asyncio
+
+from aiogram import types
+from aiogram.methods import SendMessage, EditMessageText
+
+import main
+from update_queue import ChatOrderedQueue
+
+CHAT_ID = 7
+
+
+def callback_update(update_id: int, data: str, message_id: int = 50) -> dict:
+    user = {"id": CHAT_ID, "is_bot": False, "first_name": "Тест"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": "c", "data": data,
+            "message": {"message_id": message_id, "date": 0, "chat": {"id": CHAT_ID, "type": "private"}, "text": "?"},
+        },
+    }
+
+
+def test_double_tap_runs_one_generation(monkeypatch):
+    sent = []
+    llm_calls = []
+
+    async def make_request(bot, method, timeout=None):
+        if isinstance(method, (SendMessage, EditMessageText)):
+            sent.append(method.text)
+            return types.Message(
+                message_id=len(sent) + 100, date=0, chat=types.Chat(id=CHAT_ID, type="private"), text=method.text
+            )
+        return True
+
+    async def call_llm(*args, **kwargs):
+        llm_calls.append(kwargs.get("chat_id"))
+        await asyncio.sleep(0.1)
+        return "## Варіант 1\nперший"
+
+    monkeypatch.setattr(main.bot.session, "make_request", make_request)
+    monkeypatch.setattr(main.delivery, "chat_interval", 0)
+    monkeypatch.setattr(main.prompt_logic, "call_llm", call_llm)
+    monkeypatch.setattr(main, "LLM_STREAMING", False)
+    monkeypatch.setattr(main, "LLM_FANOUT", False)
+    monkeypatch.setattr(main, "PREFETCH_REGENERATE", False)
+
+    async def scenario():
+        queue = ChatOrderedQueue(main.process_update, workers=2)
+        monkeypatch.setattr(main, "update_queue", queue)
+        queue.start()
+        # Два натискання поспіль: друге приходить, поки перше ще в черзі чату
+        first = await main.handle_webhook(callback_update(9001, "regenerate"))
+        second = await main.handle_webhook(callback_update(9002, "regenerate"))
+        await asyncio.sleep(0.05)
+        while await main.generation_guard.is_running_anywhere(CHAT_ID):
+            await asyncio.sleep(0.05)
+        # Запізніле натискання на ту саму кнопку після завершення генерації
+        late = await main.handle_webhook(callback_update(9003, "regenerate"))
+        await queue.stop(drain_timeout=1)
+        return first, second, late
+
+    first, second, late = asyncio.run(scenario())
+    assert first["status"] == "ok"
+    assert second["status"] == "duplicate"
+    assert late["status"] == "duplicate"
+    assert len(llm_calls) == 1
+    assert sent.count("Що робимо далі?") == 1
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from collections import deque
+
+from aiogram import types
+
+
+def update_chat_key(update: types.Update):
+    """Ключ впорядкування для апдейту: id чату (або користувача), інакше сам апдейт."""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id
+    return ("update", update.update_id)
+
+
+class ChatOrderedQueue:
+    """Обмежена черга з пулом воркерів.
+
+    Апдейти одного чату обробляються строго по черзі, різні чати — паралельно.
+    Якщо черга заповнена, submit чекає на вільне місце не довше timeout.
+    """
+
+    def __init__(self, handler, workers: int = 8, max_pending: int = 1000):
+        self._handler = handler
+        self._workers_count = workers
+        self._slots = asyncio.Semaphore(max_pending)
+        self._pending = {}  # ключ чату -> deque апдейтів (існує, поки чат у роботі)
+        self._ready = asyncio.Queue()
+        self._workers = []
+        self._size = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def start(self):
+        self._closed = False
+        for idx in range(self._workers_count):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"update-worker-{idx}"))
+
+    async def submit(self, key, item, timeout: float = None) -> bool:
+        """Ставить апдейт у чергу; повертає False, якщо місця не знайшлося."""
+        if self._closed:
+            return False
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        self._size += 1
+        self._idle.clear()
+        queue = self._pending.get(key)
+        if queue is None:
+            self._pending[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            queue.append(item)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            item = queue.popleft()
+            try:
+                await self._handler(item)
+            except Exception:
+                logging.exception("Помилка під час обробки апдейту")
+            finally:
+                self._slots.release()
+                self._size -= 1
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                if self._size == 0:
+                    self._idle.set()
+
+    async def stop(self, drain_timeout: float = None):
+        """Перестає приймати апдейти, дочікується обробки черги і зупиняє воркерів."""
+        self._closed = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не вдалося дочекатися обробки {self._size} апдейтів перед зупинкою")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
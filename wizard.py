@@ -0,0 +1,127 @@
+from typing import NamedTuple, Optional, Tuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+def format_button_label(text: str, icon: str) -> str:
+    sanitized_text = text.strip()
+    if not sanitized_text:
+        return icon.strip()
+
+    chars = list(sanitized_text)
+    for idx, char in enumerate(chars):
+        if char.isalpha():
+            chars[idx] = char.upper()
+            break
+
+    label = ''.join(chars)
+    if icon:
+        return f"{icon} {label}"
+    return label
+
+
+SKIP_STEP_BUTTON_TEXT = format_button_label("Пропустити", "⏩")
+CHOICE_BUTTON_ICON = ""
+SKIP_STEP_CALLBACK = "skip_step"
+CHOICE_CALLBACK_PREFIX = "s:"
+LEGACY_CHOICE_CALLBACK_PREFIX = "select:"
+
+# --- Кроки ---
+# Таблиця кроків майстра: щоб додати поле, достатньо додати рядок сюди
+WIZARD_STEPS = [
+    { 'key': 'features',     'type': 'text',   'label': 'Ключові особливості', 'question': "Опишіть про що буде допис" },
+    { 'key': 'platform',     'type': 'choice', 'label': 'Платформа', 'question': "Оберіть платформу.", 'options': ['Instagram', 'Facebook', 'Tik-Tok'] },
+    { 'key': 'objectStatus', 'type': 'choice', 'label': 'Статус об\'єкта', 'question': "Оберіть статус об'єкта.", 'options': ['Об\'єкт зданий', 'Робота в процесі'] },
+    { 'key': 'street',       'type': 'text',   'label': 'Вулиця', 'question': "Вкажіть вулицю (можна пропустити)." },
+    { 'key': 'district',     'type': 'text',   'label': 'Район', 'question': "Вкажіть район (напр: Аркадія)." },
+    { 'key': 'propertyType', 'type': 'choice', 'label': 'Тип нерухомості', 'question': "Оберіть тип нерухомості.", 'options': ['Квартира', 'Апартаменти', 'Будинок', 'Комерційне приміщення'] },
+    { 'key': 'complexName',  'type': 'text',   'label': 'Назва ЖК', 'question': "Вкажіть назву ЖК (можна пропустити)." },
+    { 'key': 'area',         'type': 'text',   'label': 'Площа, м²', 'question': "Яка площа об'єкта в м²?" },
+    { 'key': 'rooms',        'type': 'choice', 'label': 'К-ть кімнат', 'question': "Оберіть кількість кімнат.", 'options': ['1', '2', '3', '4+', 'Студія'] },
+    { 'key': 'goal',         'type': 'choice', 'label': 'Мета тексту', 'question': "Оберіть головну мету тексту.", 'options': ['Продемонструвати якість та деталі', 'Показати експертність', 'Створити емоційний зв\'язок', 'Залучити на консультацію', 'Розповісти історію \"до/після\"'] },
+    { 'key': 'variations',   'type': 'choice', 'label': 'Кількість варіантів допису', 'question': "Скільки варіантів допису згенерувати?", 'options': ['1', '2', '3'] },
+]
+
+
+class WizardStep(NamedTuple):
+    index: int
+    key: str
+    type: str
+    label: str
+    question: str
+    options: Tuple[str, ...]
+    keyboard: InlineKeyboardMarkup
+
+    def answered_text(self, value: str) -> str:
+        return f"{self.question}\n\n*✅ Ваш вибір: {value}*"
+
+
+def build_choice_keyboard(options, step_index: int):
+    buttons = [
+        InlineKeyboardButton(
+            text=format_button_label(option, CHOICE_BUTTON_ICON),
+            callback_data=f"{CHOICE_CALLBACK_PREFIX}{step_index}:{idx}"
+        )
+        for idx, option in enumerate(options)
+    ]
+
+    max_label_length = max((len(button.text) for button in buttons), default=0)
+    row_size = 1 if max_label_length > 22 else 2
+
+    return [buttons[i:i + row_size] for i in range(0, len(buttons), row_size)]
+
+
+def compile_steps(steps) -> Tuple[WizardStep, ...]:
+    """Будує незмінну модель майстра з клавіатурами, підготовленими наперед."""
+    compiled = []
+    for idx, step in enumerate(steps):
+        options = tuple(step.get('options', ()))
+        if step['type'] == 'choice':
+            rows = build_choice_keyboard(options, idx)
+        else:
+            rows = [[InlineKeyboardButton(text=SKIP_STEP_BUTTON_TEXT, callback_data=SKIP_STEP_CALLBACK)]]
+        compiled.append(WizardStep(
+            index=idx,
+            key=step['key'],
+            type=step['type'],
+            label=step['label'],
+            question=step['question'],
+            options=options,
+            keyboard=InlineKeyboardMarkup(inline_keyboard=rows),
+        ))
+    return tuple(compiled)
+
+
+STEPS = compile_steps(WIZARD_STEPS)
+STEP_INDEX = {step.key: step.index for step in STEPS}
+
+
+def parse_choice_callback(data: str) -> Optional[Tuple[WizardStep, str]]:
+    """Розбирає callback вибору (`s:<крок>:<варіант>` або старий `select:<ключ>:<варіант>`)."""
+    if data.startswith(CHOICE_CALLBACK_PREFIX):
+        parts = data[len(CHOICE_CALLBACK_PREFIX):].split(':')
+        if len(parts) != 2:
+            return None
+        raw_step, raw_idx = parts
+        try:
+            step = STEPS[int(raw_step)]
+        except (ValueError, IndexError):
+            return None
+    elif data.startswith(LEGACY_CHOICE_CALLBACK_PREFIX):
+        parts = data.split(':')
+        if len(parts) != 3 or parts[1] not in STEP_INDEX:
+            return None
+        step = STEPS[STEP_INDEX[parts[1]]]
+        raw_idx = parts[2]
+    else:
+        return None
+
+    if step.type != 'choice':
+        return None
+    try:
+        option_index = int(raw_idx)
+        if option_index < 0:
+            return None
+        return step, step.options[option_index]
+    except (ValueError, IndexError):
+        return None